@@ -0,0 +1,55 @@
+import sys
+import threading
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+_backends = []
+
+
+class LazyBackend(object):
+    """
+    A class attribute that is created by ``factory`` on first access rather
+    than on import, and kept until one of ``setting_names`` changes.
+    """
+    def __init__(self, factory, *setting_names):
+        self.factory = factory
+        self.setting_names = setting_names
+        self.value = None
+        self.resolved = False
+        self.lock = threading.Lock()
+        _backends.append(self)
+
+    def __get__(self, instance, owner):
+        if not self.resolved:
+            with self.lock:
+                if not self.resolved:
+                    self.value = self.factory()
+                    self.resolved = True
+        return self.value
+
+    def reset(self):
+        with self.lock:
+            self.value = None
+            self.resolved = False
+
+
+def get_cache_backend():
+    return get_cache(getattr(settings, 'FORM_PREVIEW_CACHE_ALIAS', 'default'))
+
+
+def lazy_cache_backend():
+    return LazyBackend(get_cache_backend, 'FORM_PREVIEW_CACHE_ALIAS', 'CACHES')
+
+
+def reset_backends(setting=None, **kwargs):
+    for backend in _backends:
+        if setting is None or setting in backend.setting_names:
+            backend.reset()
+
+
+# Settings only change under the test tools, which have imported the signal
+# by then; importing it here would load them all into production processes.
+if 'django.test.signals' in sys.modules:
+    sys.modules['django.test.signals'].setting_changed.connect(reset_backends)
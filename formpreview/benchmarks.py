@@ -0,0 +1,253 @@
+"""
+Benchmarks for the input -> preview -> post pipeline.
+
+Drives FormView, CreateView and UpdateView through all three stages with a
+local-memory cache and a temporary directory storage, and reports latency
+percentiles, retained objects and backend call counts per stage. The
+model views use PostCacheEntry, the only model shipped with the package,
+so the database tables must exist. The rows they write are rolled back.
+"""
+from collections import defaultdict
+from datetime import timedelta
+import gc
+import json
+import shutil
+import tempfile
+import time
+import uuid
+
+from django import forms
+from django.core.cache import get_cache
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
+from django.forms import models as model_forms
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from .cache import CachePostCache
+from .cache.registry import FileRegistry
+from .files import FileCache, HashedFileCache
+from .models import PostCacheEntry
+from .views import CreateView, FormView, UpdateView
+
+
+STAGES = ('input', 'preview', 'post')
+EXPECTED_STATUS = {'input': 200, 'preview': 200, 'post': 302}
+
+SCENARIOS = [
+    {'name': 'form-small', 'view': 'form', 'fields': 5, 'files': 0, 'file_size': 0, 'payload_size': 100},
+    {'name': 'form-large', 'view': 'form', 'fields': 50, 'files': 3, 'file_size': 64 * 1024, 'payload_size': 10 * 1024},
+    {'name': 'create', 'view': 'create', 'fields': 10, 'files': 1, 'file_size': 1024 * 1024, 'payload_size': 1024},
+    {'name': 'update', 'view': 'update', 'fields': 10, 'files': 1, 'file_size': 64 * 1024, 'payload_size': 1024},
+]
+
+INPUT_TEMPLATE = Template('{{ cache_key }}{{ form.as_table }}')
+PREVIEW_TEMPLATE = Template('{{ cache_key }}{{ form.preview_as_table }}')
+
+
+class CallCounter(object):
+    """
+    Proxies a backend and counts calls to its methods.
+    """
+    def __init__(self, target, counts, prefix):
+        self._target = target
+        self._counts = counts
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self._counts[self._prefix + name] += 1
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+class BenchmarkViewMixin(object):
+    post_cache_class = CachePostCache
+    success_url = '/'
+
+    def render_to_response(self, context, **response_kwargs):
+        template = PREVIEW_TEMPLATE if self.stage == 'preview' else INPUT_TEMPLATE
+        return HttpResponse(template.render(Context(context)))
+
+
+class Environment(object):
+    """
+    Swaps the cache and storage backends for counted, local ones.
+    """
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.location = tempfile.mkdtemp()
+        self.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache', LOCATION='formpreview-benchmark'
+        )
+        self.replacements = [
+            (FileCache, '_storage', CallCounter(FileSystemStorage(self.location), self.counts, 'storage.')),
+            (CachePostCache, '_cache', CallCounter(self.cache, self.counts, 'cache.')),
+            (FileRegistry, '_cache', CallCounter(self.cache, self.counts, 'registry.')),
+            (HashedFileCache, '_refs', CallCounter(self.cache, self.counts, 'refs.')),
+        ]
+
+    def __enter__(self):
+        self.originals = [(obj, name, obj.__dict__[name]) for obj, name, value in self.replacements]
+        for obj, name, value in self.replacements:
+            setattr(obj, name, value)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for obj, name, value in self.originals:
+            setattr(obj, name, value)
+        self.cache.clear()
+        shutil.rmtree(self.location, ignore_errors=True)
+
+
+def create_form_class(scenario, base=forms.Form):
+    attrs = dict(
+        ('text_%d' % i, forms.CharField(required=False)) for i in range(scenario['fields'])
+    )
+    attrs['body'] = forms.CharField(widget=forms.Textarea, required=False)
+    attrs.update(('file_%d' % i, forms.FileField()) for i in range(scenario['files']))
+    return type(str('BenchmarkForm'), (base,), attrs)
+
+
+def create_view(scenario):
+    if scenario['view'] == 'form':
+        return type(str('BenchmarkFormView'), (BenchmarkViewMixin, FormView), {
+            'form_class': create_form_class(scenario),
+        })
+    form_class = model_forms.modelform_factory(
+        PostCacheEntry, form=create_form_class(scenario, forms.ModelForm), fields=['key', 'expires_at']
+    )
+    base = CreateView if scenario['view'] == 'create' else UpdateView
+    return type(str('BenchmarkModelView'), (BenchmarkViewMixin, base), {
+        'form_class': form_class,
+        'model': PostCacheEntry,
+    })
+
+
+def create_data(scenario, key):
+    data = dict(('text_%d' % i, 'x' * 10) for i in range(scenario['fields']))
+    data['body'] = 'x' * scenario['payload_size']
+    data['key'] = key
+    data['expires_at'] = (timezone.now() + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+    for i in range(scenario['files']):
+        data['file_%d' % i] = SimpleUploadedFile('file_%d.jpg' % i, b'x' * scenario['file_size'])
+    return data
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run_scenario(scenario, iterations):
+    factory = RequestFactory()
+    view = create_view(scenario).as_view()
+    latencies = defaultdict(list)
+    retained = []
+    counts = {}
+
+    with Environment() as env, transaction.atomic():
+        try:
+            for i in range(iterations):
+                key = uuid.uuid4().hex
+                kwargs = {}
+                if scenario['view'] == 'update':
+                    PostCacheEntry.objects.create(
+                        key=key, value=b'', expires_at=timezone.now() + timedelta(days=1)
+                    )
+                    kwargs = {'pk': key}
+                requests = [
+                    ('input', factory.get('/')),
+                    ('preview', factory.post('/', dict(create_data(scenario, key), stage='preview', cache_key=key))),
+                    ('post', factory.post('/', {'stage': 'post', 'cache_key': key})),
+                ]
+
+                gc.collect()
+                objects = len(gc.get_objects())
+                for stage, request in requests:
+                    env.counts.clear()
+                    start = time.time()
+                    response = view(request, **kwargs)
+                    latencies[stage].append((time.time() - start) * 1000)
+                    if response.status_code != EXPECTED_STATUS[stage]:
+                        raise AssertionError('%s stage returned %d' % (stage, response.status_code))
+                    counts[stage] = dict(env.counts)
+                gc.collect()
+                retained.append(len(gc.get_objects()) - objects)
+        finally:
+            # Leave no rows behind in the database the command runs against.
+            transaction.set_rollback(True)
+
+    return {
+        'latency': dict(
+            (stage, dict(
+                ('p%d' % p, round(percentile(values, p), 3)) for p in (50, 90, 99)
+            )) for stage, values in latencies.items()
+        ),
+        'retained_objects': percentile(retained, 50),
+        'calls': counts,
+    }
+
+
+def run(scenarios=None, iterations=20):
+    """
+    Returns the results of each scenario, keyed by scenario name.
+    """
+    return dict(
+        (scenario['name'], run_scenario(scenario, iterations))
+        for scenario in scenarios or SCENARIOS
+    )
+
+
+def compare(results, baseline, tolerance=0.25, latency=True):
+    """
+    Returns a list of regressions of the results against the baseline.
+    Backend call counts must not grow; latencies may grow by ``tolerance``
+    where the baseline has them.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for stage, calls in sorted(result['calls'].items()):
+            expected_calls = expected['calls'].get(stage, {})
+            for call, count in sorted(calls.items()):
+                if count > expected_calls.get(call, 0):
+                    regressions.append('%s: %s %s called %d times, baseline %d' % (
+                        name, stage, call, count, expected_calls.get(call, 0)))
+        if not latency or 'latency' not in expected:
+            continue
+        for stage, values in sorted(result['latency'].items()):
+            limit = expected['latency'][stage]['p50'] * (1 + tolerance)
+            if values['p50'] > limit:
+                regressions.append('%s: %s p50 %.2fms, baseline %.2fms' % (
+                    name, stage, values['p50'], expected['latency'][stage]['p50']))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path, latency=True):
+    """
+    Saves the results as a baseline. Latencies depend on the machine, so
+    leave them out of baselines that are shared.
+    """
+    if not latency:
+        results = dict(
+            (name, dict((k, v) for k, v in result.items() if k != 'latency'))
+            for name, result in results.items()
+        )
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True, separators=(',', ': '))
@@ -1,4 +1,4 @@
-from base import get_post_cache_class
+from base import PostCacheConflict, get_post_cache_class
 from cache import CachePostCache
 
-__all__ = ['get_post_cache_class', 'CachePostCache']
+__all__ = ['get_post_cache_class', 'CachePostCache', 'PostCacheConflict']
@@ -1,9 +1,29 @@
+import time
+import uuid
+
 from django.conf import settings
 from django.http.request import QueryDict
 from django.utils.datastructures import MultiValueDict
 from django.utils.module_loading import import_by_path
 
-from ..files import FileCache
+from ..backends import LazyBackend
+from ..files import get_file_cache_class
+from ..metrics import get_collector
+from ..quotas import Quota
+from registry import FileRegistry
+from serializers import get_serializer
+from uploads import UPLOAD_SUFFIX, UploadRegistry
+
+
+# Keys of the cached payload other than extra values.
+PAYLOAD_KEYS = ('data', 'files', 'version', 'entry_id', 'digests')
+
+
+class PostCacheConflict(Exception):
+    """
+    Raised when the cached data kept changing under a save, so it could
+    not be stored within the retries.
+    """
 
 
 def overwrite_dict(base, *args):
@@ -31,70 +51,344 @@ def overwrite_dict(base, *args):
 
 
 class PostCacheBase(object):
-    file_cache = FileCache()
+    file_cache = LazyBackend(lambda: get_file_cache_class()(), 'FORM_PREVIEW_FILE_CACHE')
+    file_registry = LazyBackend(FileRegistry)
+    upload_registry = LazyBackend(lambda: UploadRegistry(get_cache_timeout()), 'FORM_PREVIEW_CACHE_TIMEOUT')
+    serializer = LazyBackend(get_serializer, 'FORM_PREVIEW_SERIALIZER')
+    metrics = LazyBackend(get_collector, 'FORM_PREVIEW_METRICS_COLLECTOR')
 
-    def __init__(self, key):
+    def __init__(self, key, new=False):
         self.key = key
-        cached_data = self.get_cache(key)
+        self._loaded = False
+        self._files = None
+        # Files written during this request, reused instead of re-opened.
+        self._written_files = {}
+        self._deferred_files = []
+        self._pending = None
+        if new:
+            # A key minted for this request can never be in the cache.
+            self._set_loaded(None)
+
+    def _set_loaded(self, cached_data):
         if cached_data:
             self._post = cached_data['data']
-            self._files = self.load_files(cached_data['files'])
+            self._paths = cached_data['files']
+            self.version = cached_data.get('version', 0)
+            # Empty for entries stored before saves were versioned.
+            self.entry_id = cached_data.get('entry_id', '')
+            self._digests = cached_data.get('digests', {})
+            self.extra = dict(
+                (k, v) for k, v in cached_data.items() if k not in PAYLOAD_KEYS
+            )
         else:
             self._post = MultiValueDict()
-            self._files = MultiValueDict()
+            self._paths = MultiValueDict()
+            self.version = 0
+            self.entry_id = None
+            self._digests = {}
+            self.extra = {}
+        self._files = None
+        self._loaded = True
+
+    def load(self):
+        if self._loaded:
+            return
+        with self.metrics.timer('cache.load'):
+            value = self.get_cache(self.key)
+            self._set_loaded(self.serializer.loads(value) if value is not None else None)
+        if self.metrics.enabled:
+            self.metrics.incr('cache.miss' if value is None else 'cache.hit')
+            if isinstance(value, bytes):
+                self.metrics.histogram('cache.payload_bytes', len(value))
+
+    def reload(self):
+        self._loaded = False
+        self.load()
+
+    def write(self, cached_data):
+        """
+        Stores the cached data unless another request has stored a newer
+        version since it was loaded, and returns whether it did.
+        """
+        value = self.serializer.dumps(cached_data)
+        with self.metrics.timer('cache.save'):
+            written = self.set_cache_if(self.key, value, self.version, self.entry_id)
+        if self.metrics.enabled and isinstance(value, bytes):
+            self.metrics.histogram('cache.payload_bytes', len(value))
+        return written
 
     def save(self, request):
-        files = self.save_files(request.FILES)
-        cached_data = self.get_cache(self.key)
-        cached_files = cached_data['files'] if cached_data else MultiValueDict()
-        cached_files = self.remove_cleared_files(request, cached_files)
-        files = overwrite_dict(cached_files, files)
+        self.prepare(request)
+        self.commit()
 
+    def prepare(self, request):
+        """
+        Merges the request into the cached data in memory, so the form can
+        be validated before anything is written. ``commit()`` writes it.
+        """
+        self.load()
+        quota = self.get_quota()
+        quota.check_data(request.POST)
+        uploads = MultiValueDict(request.FILES)
+        completed_paths, upload_ids = self.get_completed_uploads(request.POST, exclude=uploads)
+        new_files = overwrite_dict(self.load_files(completed_paths), uploads)
+        if new_files:
+            quota.check_files(new_files)
         post = request.POST.copy()
-        self.set_cache(self.key, {'data': post, 'files': files})
+        cached_files, cleared_files = self.split_cleared_files(post, self._paths.copy(), new_files)
+        kept_files = MultiValueDict(dict(
+            (key, values) for key, values in cached_files.lists() if key not in new_files
+        ))
 
+        self._pending = {
+            'post': post,
+            'quota': quota,
+            'uploads': uploads,
+            'completed_paths': completed_paths,
+            'upload_key': self.key,
+            'upload_ids': upload_ids,
+        }
+        self._pending.update(self.get_loaded_state())
         self._post = post
-        self._files = self.load_files(files)
+        self._files = overwrite_dict(self.load_files(kept_files), new_files)
+
+    def get_loaded_state(self):
+        return {'cached_post': self._post, 'cached_paths': self._paths, 'cached_extra': self.extra}
+
+    def get_completed_uploads(self, data, exclude=()):
+        """
+        Returns the paths of the completed chunked uploads that the data
+        refers to by ``<field>__upload`` values, by field, and their ids.
+        """
+        field_ids = MultiValueDict()
+        for key, values in data.lists():
+            field = key[:-len(UPLOAD_SUFFIX)]
+            if key.endswith(UPLOAD_SUFFIX) and field not in exclude:
+                field_ids.setlist(field, [v for v in values if v])
+        upload_ids = [v for key, values in field_ids.lists() for v in values]
+        if not upload_ids:
+            return MultiValueDict(), []
+
+        uploads = self.upload_registry.get_many(self.key, upload_ids)
+        paths = MultiValueDict()
+        completed_ids = []
+        for field, values in field_ids.lists():
+            for upload_id in values:
+                upload = uploads.get(upload_id)
+                if upload and upload['path'] and upload['field'] in (None, field):
+                    paths.appendlist(field, upload['path'])
+                    completed_ids.append(upload_id)
+        return paths, completed_ids
+
+    def commit_files(self):
+        """
+        Saves the uploads of the prepared request. ``commit()`` calls it,
+        but it can be called first to get at the paths of the files.
+        """
+        pending = self._pending
+        if 'files' in pending:
+            return
+        uploads = pending['uploads']
+        upload_digests = {}
+        if self.is_incremental():
+            uploads, upload_digests = self.split_unchanged_files(uploads, self._paths)
+        saved_files = self.save_files(uploads, pending['quota'])
+        new_digests = {}
+        for key, paths in saved_files.lists():
+            new_digests.update(zip(paths, upload_digests.get(key, [])))
+        pending['saved_files'] = saved_files
+        pending['new_digests'] = new_digests
+        pending['new_keys'] = set(pending['uploads']) | set(pending['completed_paths'])
+        pending['new_files'] = overwrite_dict(MultiValueDict(pending['completed_paths']), saved_files)
+        self.merge_files(pending)
+
+    def merge_files(self, pending):
+        """
+        Merges the new files into the cached files that were loaded last.
+        """
+        new_files = pending['new_files']
+        cached_files, cleared_files = self.split_cleared_files(
+            pending['post'], self._paths.copy(), pending['new_keys']
+        )
+        digests = dict(self._digests)
+        digests.update(pending['new_digests'])
+        pending.update({
+            'cleared_files': cleared_files,
+            'replaced_files': MultiValueDict(dict(
+                (key, cached_files.getlist(key)) for key in new_files if key in cached_files
+            )),
+            'files': overwrite_dict(cached_files, new_files),
+            'digests': digests,
+        })
+        self._paths = pending['files']
+        self._files = None
+
+    def is_incremental(self):
+        return getattr(settings, 'FORM_PREVIEW_INCREMENTAL_SAVE', False)
+
+    def split_unchanged_files(self, uploads, cached_files):
+        """
+        Leaves out the fields whose uploads have the same content as their
+        cached files. Returns the rest, and the digests of their uploads by
+        field.
+        """
+        changed = MultiValueDict()
+        digests = {}
+        for key, values in uploads.lists():
+            upload_digests = [self.file_cache.get_digest(v) for v in values]
+            if upload_digests == [self._digests.get(path) for path in cached_files.getlist(key)]:
+                continue
+            changed.setlist(key, values)
+            digests[key] = upload_digests
+        return changed, digests
+
+    def is_unchanged(self, pending, extra):
+        return (
+            not pending['cleared_files'] and
+            sorted(self._post.lists()) == sorted(pending['cached_post'].lists()) and
+            sorted(pending['files'].lists()) == sorted(pending['cached_paths'].lists()) and
+            extra == pending['cached_extra']
+        )
+
+    def make_payload(self, post, files, digests, extra):
+        cached_data = dict(
+            extra, data=post, files=files, version=self.version + 1, entry_id=self.entry_id or uuid.uuid4().hex
+        )
+        if self.is_incremental():
+            paths = set(v for key, values in files.lists() for v in values)
+            cached_data['digests'] = dict((k, v) for k, v in digests.items() if k in paths)
+        return cached_data
+
+    def get_max_retries(self):
+        return getattr(settings, 'FORM_PREVIEW_CONFLICT_RETRIES', 3)
 
-    def remove_cleared_files(self, request, cached_files):
+    def get_retry_delay(self):
+        return getattr(settings, 'FORM_PREVIEW_CONFLICT_RETRY_DELAY', 0.05)
+
+    def commit(self, **extra):
+        """
+        Writes the prepared request, along with extra values, in one write.
+        In incremental mode nothing is written when nothing has changed.
+
+        When another request has saved the same key in the meantime, the
+        files are merged into its version and the write is retried.
+        """
+        self.commit_files()
+        pending, self._pending = self._pending, None
+        for attempt in range(self.get_max_retries() + 1):
+            if attempt:
+                self.metrics.incr('cache.conflict')
+                time.sleep(self.get_retry_delay() * attempt)
+                self.reload()
+                pending.update(self.get_loaded_state())
+                self._post = pending['post']
+                self.merge_files(pending)
+            if self.is_incremental() and self.is_unchanged(pending, extra):
+                self.metrics.incr('cache.unchanged')
+                return
+            cached_data = self.make_payload(self._post, pending['files'], pending['digests'], extra)
+            if self.write(cached_data):
+                break
+        else:
+            # Don't leave the files of this request behind.
+            self.delete_files(pending['saved_files'])
+            raise PostCacheConflict('The cached data of %s kept changing.' % self.key)
+
+        files = pending['files']
+        self.file_registry.register(
+            self.key, [v for key, values in files.lists() for v in values], get_cache_timeout()
+        )
+        self._set_loaded(cached_data)
+        if pending['upload_ids']:
+            # The uploads belong to the cached data now.
+            self.upload_registry.delete_many(pending['upload_key'], pending['upload_ids'])
+        self.delete_files(pending['replaced_files'])
+        self.delete_files(pending['cleared_files'])
+
+    def split_cleared_files(self, data, cached_files, new_files):
+        """
+        Removes the files cleared by the data from ``cached_files`` and
+        returns both.
+        """
+        cleared_files = MultiValueDict()
         for key, values in cached_files.lists():
-            is_clear = bool(request.POST.get(key + '-clear', False))
-            if key not in request.FILES and is_clear:
-                for val in cached_files.getlist(key):
-                    self.file_cache.delete(val)
+            is_clear = bool(data.get(key + '-clear', False))
+            if key not in new_files and is_clear:
+                cleared_files.setlist(key, values)
                 del cached_files[key]
-        return cached_files
+        return cached_files, cleared_files
 
-    def clear(self):
-        self.delete_files(self._files)
-        self._cache.delete(self.key)
-        self._post = MultiValueDict()
-        self._files = MultiValueDict()
+    def clear(self, defer=False):
+        """
+        Deletes the cached data. With ``defer``, deleting the files is left
+        to ``close()`` so it can run after the response has been sent.
+        """
+        self.load()
+        self.delete_cache(self.key)
+        if defer:
+            self._deferred_files.append(self._paths)
+        else:
+            self.delete_files(self._paths)
+        self._set_loaded(None)
 
-    def save_files(self, files):
-        saved_files = MultiValueDict()
+    def close(self):
+        deferred_files, self._deferred_files = self._deferred_files, []
+        for files in deferred_files:
+            self.delete_files(files)
+
+    def get_quota(self):
+        return Quota()
+
+    def save_files(self, files, quota=None):
         files = MultiValueDict(files)
+        file_objects = [v for key, values in files.lists() for v in values]
+        if not file_objects:
+            return MultiValueDict()
+        if quota is not None:
+            quota.check_files(files)
+        with self.metrics.timer('files.save'):
+            paths = self.file_cache.save_many(file_objects, quota=quota)
+        self.metrics.incr('files.saved', len(paths))
+        self._written_files.update(zip(paths, file_objects))
+
+        paths = iter(paths)
+        saved_files = MultiValueDict()
         for key, values in files.lists():
-            saved_files.setlist(key, [self.file_cache.save(v) for v in values])
+            saved_files.setlist(key, [next(paths) for v in values])
         return saved_files
 
+    def wait_files(self, timeout=None):
+        """
+        Waits until the cached files have been written to the storage.
+        """
+        self.load()
+        self.file_cache.wait([v for key, values in self._paths.lists() for v in values], timeout)
+
     def load_files(self, files):
         loaded_files = MultiValueDict()
-        for key, values in files.lists():
-            loaded_files.setlist(key, [self.file_cache.load(v) for v in values])
+        with self.metrics.timer('files.load'):
+            for key, values in files.lists():
+                loaded_files.setlist(key, [
+                    self.file_cache.load(v, self._written_files.get(v)) for v in values
+                ])
+        self.metrics.incr('files.loaded', sum(len(values) for key, values in files.lists()))
         return loaded_files
 
     def delete_files(self, files):
-        for key, values in files.lists():
-            for v in values:
-                self.file_cache.delete(v)
+        paths = [v for key, values in files.lists() for v in values]
+        if paths:
+            self.file_cache.delete_many(paths)
 
     @property
     def POST(self):
+        self.load()
         return self._post
 
     @property
     def FILES(self):
+        self.load()
+        if self._files is None:
+            self._files = self.load_files(self._paths)
         return self._files
 
     def get_cache(self, key, default=None):
@@ -103,6 +397,24 @@ class PostCacheBase(object):
     def set_cache(self, key, data, expires=None):
         raise NotImplementedError()
 
+    def set_cache_if(self, key, data, version, entry_id=None, expires=None):
+        """
+        Stores the data unless a version newer than ``version`` has been
+        stored, and returns whether it did. ``entry_id`` identifies the
+        loaded entry: None if there was none, and empty if it was stored
+        before saves were versioned, in which case it is overwritten.
+        Backends that can't compare and set store it regardless.
+        """
+        self.set_cache(key, data, expires)
+        return True
+
+    def delete_cache(self, key):
+        raise NotImplementedError()
+
+
+def get_cache_timeout():
+    return getattr(settings, 'FORM_PREVIEW_CACHE_TIMEOUT', 24 * 60 * 60)
+
 
 def get_post_cache_class(import_path=None):
     if not import_path:
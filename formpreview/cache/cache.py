@@ -1,16 +1,63 @@
 from django.conf import settings
-from django.core.cache import get_cache
 
-from base import PostCacheBase
+from ..backends import lazy_cache_backend
+from base import PostCacheBase, get_cache_timeout
 
 
 class CachePostCache(PostCacheBase):
-    _cache = get_cache(getattr(settings, 'FORM_PREVIEW_CACHE_ALIAS', 'default'))
+    """
+    Saves are compare-and-set: a new entry is added only if there is none,
+    and each later version of an entry can be claimed by a single writer.
+    """
+    _cache = lazy_cache_backend()
+
+    def get_claim_key(self, key, entry_id, version):
+        # Scoped to the entry, so claims that outlive an evicted entry
+        # don't block the one that replaces it.
+        return 'formpreview-claim:%s:%s:%d' % (key, entry_id, version)
+
+    def get_claim_timeout(self):
+        return getattr(settings, 'FORM_PREVIEW_CONFLICT_CLAIM_TIMEOUT', 10)
+
+    def is_current(self, key, version, entry_id):
+        value = self._cache.get(key, None)
+        if value is None:
+            return False
+        cached_data = self.serializer.loads(value)
+        return cached_data.get('entry_id') == entry_id and cached_data.get('version', 0) == version
 
     def get_cache(self, key):
         return self._cache.get(key, None)
 
     def set_cache(self, key, value, expires=None):
         if not expires:
-            expires = 24 * 60 * 60
+            expires = get_cache_timeout()
         self._cache.set(key, value, expires)
+
+    def set_cache_if(self, key, value, version, entry_id=None, expires=None):
+        if not expires:
+            expires = get_cache_timeout()
+        if entry_id is None:
+            return self._cache.add(key, value, expires)
+        if not entry_id:
+            # Stored before saves were versioned; there is nothing to claim.
+            self._cache.set(key, value, expires)
+            return True
+        # Only one writer at a time can claim the version after the loaded
+        # one. Claims expire shortly, so one left by a writer that died or
+        # whose write was dropped doesn't block the entry; the stored
+        # version tells whether the claimed version was written meanwhile.
+        claim_key = self.get_claim_key(key, entry_id, version)
+        if not self._cache.add(claim_key, 1, self.get_claim_timeout()):
+            return False
+        try:
+            if not self.is_current(key, version, entry_id):
+                return False
+            self._cache.set(key, value, expires)
+        except Exception:
+            self._cache.delete(claim_key)
+            raise
+        return True
+
+    def delete_cache(self, key):
+        self._cache.delete(key)
@@ -0,0 +1,68 @@
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.six.moves import cPickle as pickle
+
+from base import PostCacheBase, get_cache_timeout
+from ..models import PostCacheEntry
+
+
+class DatabasePostCache(PostCacheBase):
+    """
+    A post cache stored in the database, so previews survive cache evictions.
+    Requires 'formpreview' in INSTALLED_APPS. Saves only update the row
+    if its version is still the one that was loaded.
+    """
+    model = PostCacheEntry
+
+    def get_cache(self, key):
+        values = self.model.objects.filter(
+            key=key, expires_at__gt=timezone.now()
+        ).values_list('value', flat=True)[:1]
+        for value in values:
+            return pickle.loads(bytes(value))
+        return None
+
+    def get_fields(self, value, expires=None):
+        if not expires:
+            expires = get_cache_timeout()
+        return {
+            'value': pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            'expires_at': timezone.now() + timedelta(seconds=expires),
+        }
+
+    def set_cache(self, key, value, expires=None):
+        fields = self.get_fields(value, expires)
+        if self.model.objects.filter(key=key).update(**fields):
+            return
+        try:
+            with transaction.atomic():
+                self.model.objects.create(key=key, **fields)
+        except IntegrityError:
+            # Inserted concurrently by another request.
+            self.model.objects.filter(key=key).update(**fields)
+
+    def set_cache_if(self, key, value, version, entry_id=None, expires=None):
+        fields = self.get_fields(value, expires)
+        fields['version'] = version + 1
+        entries = self.model.objects.filter(key=key)
+        if entry_id is not None:
+            # Rows stored before saves were versioned are still at 0.
+            return entries.filter(version=version if entry_id else 0).update(**fields) == 1
+        # Nothing was loaded: take over an expired entry, or insert a new one.
+        if entries.filter(expires_at__lte=timezone.now()).update(**fields):
+            return True
+        try:
+            with transaction.atomic():
+                self.model.objects.create(key=key, **fields)
+        except IntegrityError:
+            return False
+        return True
+
+    def delete_cache(self, key):
+        self.model.objects.filter(key=key).delete()
+
+    @classmethod
+    def delete_expired(cls):
+        cls.model.objects.filter(expires_at__lte=timezone.now()).delete()
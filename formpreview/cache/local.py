@@ -0,0 +1,105 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+
+from ..backends import LazyBackend
+from cache import CachePostCache
+
+
+class LocalCache(object):
+    """
+    A bounded, thread-safe LRU cache whose entries expire after ``timeout``
+    seconds.
+    """
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.timeout, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+class LocalCachePostCache(CachePostCache):
+    """
+    A CachePostCache with a per-process LRU in front of the shared cache.
+    Writes go through to the shared cache. Another process may update the
+    shared entry in the meantime, so the local entry is only trusted for
+    the input and preview stages: a save that conflicts with a newer
+    version drops it, and the post stage reads the shared entry.
+    """
+    _local = LazyBackend(
+        lambda: LocalCache(
+            getattr(settings, 'FORM_PREVIEW_LOCAL_CACHE_MAX_ENTRIES', 1000),
+            getattr(settings, 'FORM_PREVIEW_LOCAL_CACHE_TIMEOUT', 60),
+        ),
+        'FORM_PREVIEW_LOCAL_CACHE_MAX_ENTRIES', 'FORM_PREVIEW_LOCAL_CACHE_TIMEOUT',
+    )
+
+    def get_cache(self, key):
+        value = self._local.get(key)
+        if value is None:
+            value = super(LocalCachePostCache, self).get_cache(key)
+            if value is not None:
+                self._local.set(key, value)
+        return value
+
+    def set_cache(self, key, value, expires=None):
+        super(LocalCachePostCache, self).set_cache(key, value, expires)
+        self._local.set(key, value)
+
+    def set_cache_if(self, key, value, version, entry_id=None, expires=None):
+        written = super(LocalCachePostCache, self).set_cache_if(key, value, version, entry_id, expires)
+        if written:
+            self._local.set(key, value)
+        else:
+            # Another process has saved a newer version; load that next time.
+            self._local.delete(key)
+        return written
+
+    def wait_files(self, timeout=None):
+        # Called before the post stage, which must act on the latest version.
+        self._local.delete(self.key)
+        self.reload()
+        super(LocalCachePostCache, self).wait_files(timeout)
+
+    def delete_cache(self, key):
+        self._local.delete(key)
+        super(LocalCachePostCache, self).delete_cache(key)
+
+    @classmethod
+    def stats(cls):
+        return cls._local.stats()
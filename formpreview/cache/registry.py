@@ -0,0 +1,29 @@
+import time
+
+from ..backends import lazy_cache_backend
+
+
+class FileRegistry(object):
+    """
+    Records which cache key owns each cached file, and since when.
+    """
+    _cache = lazy_cache_backend()
+
+    def get_registry_key(self, path):
+        return 'formpreview-owner:' + path
+
+    def register(self, owner, paths, timeout):
+        if not paths:
+            return
+        now = time.time()
+        self._cache.set_many(dict(
+            (self.get_registry_key(path), (owner, now)) for path in paths
+        ), timeout)
+
+    def get_owners(self, paths):
+        """
+        Returns a dict of path -> (owner, registered_at) for registered paths.
+        """
+        keys = dict((self.get_registry_key(path), path) for path in paths)
+        found = self._cache.get_many(keys.keys())
+        return dict((keys[key], value) for key, value in found.items())
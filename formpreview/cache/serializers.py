@@ -0,0 +1,72 @@
+import json
+import zlib
+
+from django.conf import settings
+from django.http.request import QueryDict
+from django.utils.datastructures import MultiValueDict
+from django.utils.module_loading import import_by_path
+
+
+class PickleSerializer(object):
+    """
+    Leaves the payload as it is, to be pickled by the cache backend.
+    """
+    def dumps(self, payload):
+        return payload
+
+    def loads(self, value):
+        return value
+
+
+class CompactSerializer(object):
+    """
+    Encodes the payload as JSON lists of (key, values) pairs, compressed
+    with zlib once it grows over ``compress_threshold`` bytes.
+    """
+    PLAIN = b'j'
+    COMPRESSED = b'z'
+
+    def __init__(self, compress_threshold=None, compress_level=6):
+        if compress_threshold is None:
+            compress_threshold = getattr(settings, 'FORM_PREVIEW_COMPRESS_THRESHOLD', 1024)
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, payload):
+        payload = dict(payload)
+        payload['data'] = list(payload['data'].lists())
+        payload['files'] = list(payload['files'].lists())
+        value = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if len(value) > self.compress_threshold:
+            compressed = self.compress(value)
+            if len(compressed) < len(value):
+                return self.COMPRESSED + compressed
+        return self.PLAIN + value
+
+    def loads(self, value):
+        if isinstance(value, dict):
+            # Entries stored before a serializer was configured.
+            return value
+        flag, value = value[:1], value[1:]
+        if flag == self.COMPRESSED:
+            value = self.decompress(value)
+        payload = json.loads(value.decode('utf-8'))
+
+        post = QueryDict('', mutable=True)
+        for key, values in payload['data']:
+            post.setlist(key, values)
+        payload['data'] = post
+        payload['files'] = MultiValueDict(dict(payload['files']))
+        return payload
+
+    def compress(self, value):
+        return zlib.compress(value, self.compress_level)
+
+    def decompress(self, value):
+        return zlib.decompress(value)
+
+
+def get_serializer(import_path=None):
+    if not import_path:
+        import_path = getattr(settings, 'FORM_PREVIEW_SERIALIZER', 'formpreview.cache.serializers.CompactSerializer')
+    return import_by_path(import_path)()
@@ -0,0 +1,91 @@
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import cached_property
+
+from base import PostCacheBase, get_cache_timeout, get_post_cache_class
+
+
+class RawSerializer(object):
+    def dumps(self, value):
+        return value
+
+    def loads(self, value):
+        return value
+
+
+class SignedPostCache(PostCacheBase):
+    """
+    Keeps the cached payload in the cache key itself, as a signed and
+    compressed token, so no server-side store is needed between stages.
+    Payloads that would exceed ``FORM_PREVIEW_SIGNED_MAX_SIZE`` are stored
+    in the fallback backend under a random key instead.
+
+    The key changes on every save; views must send ``self.key`` back to
+    the client afterwards. Each token carries a nonce, which ``clear()``
+    records in the fallback backend until the token expires, so a cleared
+    token can't be replayed.
+    """
+    prefix = 'signed:'
+    salt = 'formpreview.cache.signed.nonce'
+    nonce_length = 32
+
+    @cached_property
+    def fallback(self):
+        import_path = getattr(settings, 'FORM_PREVIEW_SIGNED_FALLBACK_BACKEND', 'formpreview.cache.CachePostCache')
+        return get_post_cache_class(import_path)(self.key, new=True)
+
+    def get_max_size(self):
+        return getattr(settings, 'FORM_PREVIEW_SIGNED_MAX_SIZE', 4096)
+
+    def is_signed(self, key):
+        return key.startswith(self.prefix)
+
+    def get_consumed_key(self, nonce):
+        return 'formpreview-consumed:%s' % nonce
+
+    def load_token(self, key):
+        """
+        Returns the nonce and the payload of a signed key, or ``(None, None)``
+        if it is invalid or has expired.
+        """
+        try:
+            value = signing.loads(
+                key[len(self.prefix):], salt=self.salt, serializer=RawSerializer, max_age=get_cache_timeout()
+            )
+        except signing.BadSignature:
+            return None, None
+        return value[:self.nonce_length].decode('ascii'), value[self.nonce_length:]
+
+    def get_cache(self, key):
+        if not self.is_signed(key):
+            return self.fallback.get_cache(key)
+        nonce, value = self.load_token(key)
+        if nonce is None or self.fallback.get_cache(self.get_consumed_key(nonce)) is not None:
+            return None
+        return value
+
+    def set_cache(self, key, value, expires=None):
+        if not isinstance(value, bytes):
+            raise ImproperlyConfigured('SignedPostCache requires a serializer that returns bytes.')
+        nonce = uuid.uuid4().hex.encode('ascii')
+        token = self.prefix + signing.dumps(nonce + value, salt=self.salt, serializer=RawSerializer, compress=True)
+        if len(token) <= self.get_max_size():
+            if not self.is_signed(key):
+                self.fallback.delete_cache(key)
+            self.key = token
+        else:
+            if self.is_signed(key):
+                key = uuid.uuid4().hex
+            self.fallback.set_cache(key, value, expires)
+            self.key = key
+
+    def delete_cache(self, key):
+        if not self.is_signed(key):
+            self.fallback.delete_cache(key)
+            return
+        nonce, value = self.load_token(key)
+        if nonce is not None:
+            self.fallback.set_cache(self.get_consumed_key(nonce), True, get_cache_timeout())
@@ -0,0 +1,186 @@
+import errno
+import os
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.core.files.base import File
+
+from ..backends import lazy_cache_backend
+from ..quotas import QuotaExceeded
+
+
+UPLOAD_SUFFIX = '__upload'
+
+
+class UploadConflict(Exception):
+    """
+    Raised when a chunk doesn't start where the upload left off.
+    """
+    def __init__(self, offset):
+        super(UploadConflict, self).__init__('The upload continues at offset %d.' % offset)
+        self.offset = offset
+
+
+class SpooledFile(File):
+    """
+    An assembled upload, which file caches can link or move like a
+    temporary upload.
+    """
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class UploadRegistry(object):
+    """
+    Assembles files uploaded in chunks and keeps them, by cache key and
+    upload id, until a submission of the form picks them up.
+
+    The chunks are spooled to ``FORM_PREVIEW_UPLOAD_SPOOL_DIR``, which must
+    be shared by all processes that receive chunks. Uploads no submission
+    has picked up yet are counted per cache key against the quota, as if
+    they were submitted together.
+    """
+    _cache = lazy_cache_backend()
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def get_upload_key(self, cache_key, upload_id):
+        return 'formpreview-upload:%s:%s' % (cache_key, upload_id)
+
+    def get_usage_key(self, cache_key, name):
+        return 'formpreview-upload-usage:%s:%s' % (cache_key, name)
+
+    def get_spool_dir(self):
+        return (
+            getattr(settings, 'FORM_PREVIEW_UPLOAD_SPOOL_DIR', None) or
+            settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir()
+        )
+
+    def get(self, cache_key, upload_id):
+        return self._cache.get(self.get_upload_key(cache_key, upload_id))
+
+    def get_many(self, cache_key, upload_ids):
+        keys = dict((self.get_upload_key(cache_key, upload_id), upload_id) for upload_id in upload_ids)
+        found = self._cache.get_many(keys.keys())
+        return dict((keys[key], upload) for key, upload in found.items())
+
+    def put(self, cache_key, upload):
+        self._cache.set(self.get_upload_key(cache_key, upload['id']), upload, self.timeout)
+
+    def start(self, cache_key, name, size, field=None, quota=None):
+        if quota is not None:
+            self.reserve(cache_key, field, size, quota)
+        upload_id = uuid.uuid4().hex
+        spool = os.path.join(self.get_spool_dir(), 'formpreview-%s.part' % upload_id)
+        open(spool, 'wb').close()
+        upload = {
+            'id': upload_id, 'name': name, 'size': size, 'field': field,
+            'offset': 0, 'spool': spool, 'path': None, 'reserved': quota is not None,
+        }
+        self.put(cache_key, upload)
+        return upload
+
+    def incr(self, key, delta):
+        if self._cache.add(key, delta, self.timeout):
+            return delta
+        try:
+            return self._cache.incr(key, delta)
+        except ValueError:
+            # Expired in the meantime.
+            self._cache.set(key, delta, self.timeout)
+            return delta
+
+    def reserve(self, cache_key, field, size, quota):
+        """
+        Counts a new upload, by its declared size, against the quota along
+        with the other uploads to the cache key. Chunks can't exceed that
+        size, so nothing more is stored than has been reserved.
+        """
+        files = self.incr(self.get_usage_key(cache_key, 'files'), 1)
+        total = self.incr(self.get_usage_key(cache_key, 'size'), size)
+        try:
+            if quota.max_files is not None and files > quota.max_files:
+                raise QuotaExceeded('At most %d files can be uploaded.' % quota.max_files)
+            quota.check_size(field, size, total)
+        except QuotaExceeded:
+            self.release(cache_key, [size])
+            raise
+
+    def release(self, cache_key, sizes):
+        for name, delta in (('files', len(sizes)), ('size', sum(sizes))):
+            try:
+                self._cache.decr(self.get_usage_key(cache_key, name), delta)
+            except ValueError:
+                pass
+
+    def append(self, cache_key, upload, offset, chunk, file_cache):
+        """
+        Writes a chunk at ``offset`` and saves the file to the file cache
+        once it is complete. Chunks must arrive in order; a chunk that
+        was received before is accepted again.
+        """
+        lock_key = self.get_upload_key(cache_key, upload['id']) + ':lock'
+        if not self._cache.add(lock_key, 1, 60):
+            raise UploadConflict(upload['offset'])
+        try:
+            upload = self.get(cache_key, upload['id']) or upload
+            if upload['path'] is not None or offset > upload['offset']:
+                raise UploadConflict(upload['offset'])
+            with open(upload['spool'], 'r+b') as spool:
+                spool.seek(offset)
+                for data in chunk.chunks():
+                    if spool.tell() + len(data) > upload['size']:
+                        raise ValueError('The chunk exceeds the size of the upload.')
+                    spool.write(data)
+                spool.truncate()
+                upload['offset'] = spool.tell()
+
+            if upload['offset'] == upload['size']:
+                upload['path'] = self.complete(upload, file_cache)
+            self.put(cache_key, upload)
+            return upload
+        finally:
+            self._cache.delete(lock_key)
+
+    def complete(self, upload, file_cache):
+        with open(upload['spool'], 'rb') as spool:
+            path = file_cache.save(SpooledFile(spool, name=upload['name']))
+        self.remove_spool(upload['spool'])
+        upload['spool'] = None
+        return path
+
+    def remove_spool(self, spool):
+        try:
+            os.remove(spool)
+        except OSError as e:
+            # Storages may have moved the file already.
+            if e.errno != errno.ENOENT:
+                raise
+
+    def delete_many(self, cache_key, upload_ids):
+        """
+        Forgets uploads that a submission has picked up, which counts them
+        against its own quota from now on.
+        """
+        uploads = self.get_many(cache_key, upload_ids).values()
+        self._cache.delete_many([self.get_upload_key(cache_key, upload_id) for upload_id in upload_ids])
+        sizes = [upload['size'] for upload in uploads if upload.get('reserved')]
+        if sizes:
+            self.release(cache_key, sizes)
+
+    def sweep_spool(self, expires):
+        """
+        Deletes the spooled chunks of uploads that were never completed.
+        """
+        cutoff = time.time() - expires
+        directory = self.get_spool_dir()
+        swept = []
+        for name in os.listdir(directory):
+            spool = os.path.join(directory, name)
+            if name.startswith('formpreview-') and name.endswith('.part') and os.path.getmtime(spool) < cutoff:
+                self.remove_spool(spool)
+                swept.append(spool)
+        return swept
@@ -1,11 +1,31 @@
-import os.path
+from io import BytesIO
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import errno
+import functools
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
 import uuid
 
 from django.conf import settings
-from django.core.files.base import File
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import default_storage
+from django.utils import six
+from django.utils.functional import cached_property
 from django.utils.module_loading import import_by_path
 
+from backends import LazyBackend, lazy_cache_backend
+from quotas import QuotaExceeded
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 
 def get_storage(import_path=None):
     if import_path:
@@ -17,38 +37,512 @@ def get_storage(import_path=None):
             return default_storage
 
 
+THUMBNAIL_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.webp')
+THUMBNAIL_SUFFIX = '.thumb'
+
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+# Results of asynchronous writes in this process, keyed by path, and the
+# exceptions of failed ones until they are waited for.
+_pending_writes = {}
+_failed_writes = {}
+_pending_writes_lock = threading.Lock()
+
+
+def _get_pool(setting_name, default):
+    pool = _thread_pools.get(setting_name)
+    if pool is None:
+        with _thread_pools_lock:
+            pool = _thread_pools.get(setting_name)
+            if pool is None:
+                pool = _thread_pools[setting_name] = ThreadPool(getattr(settings, setting_name, default))
+    return pool
+
+
+def get_thread_pool():
+    """
+    Returns the pool for work a request waits for, such as saving the
+    files of a submission concurrently.
+    """
+    return _get_pool('FORM_PREVIEW_FILE_CACHE_WORKERS', 4)
+
+
+def get_background_pool():
+    """
+    Returns the pool for work no request waits for: asynchronous writes
+    and thumbnails. Kept apart so requests don't queue behind them.
+    """
+    return _get_pool('FORM_PREVIEW_FILE_CACHE_BACKGROUND_WORKERS', 4)
+
+
 class FileCache(object):
-    _storage = get_storage()
+    hash_algorithm = 'sha1'
+    _storage = LazyBackend(get_storage, 'FORM_PREVIEW_FILE_CACHE_STORAGE')
 
-    def save(self, file_object):
-        path = self.create_filepath(file_object)
-        self._storage.save(path, file_object)
+    def save(self, file_object, quota=None):
+        path = self.write(file_object, self.create_filepath(file_object), quota)
+        self.derive(file_object, path)
+        return path
+
+    def save_many(self, file_objects, quota=None):
+        """
+        Saves several files concurrently and returns their paths in order.
+        If any of them fails, the others are deleted again.
+        """
+        file_objects = list(file_objects)
+        save = functools.partial(self.try_save, quota=quota)
+        if len(file_objects) > 1 and self.is_concurrent():
+            results = get_thread_pool().map(save, file_objects)
+        else:
+            results = []
+            for file_object in file_objects:
+                results.append(save(file_object))
+                if results[-1][1] is not None:
+                    break
+
+        errors = [exc_info for path, exc_info in results if exc_info is not None]
+        if errors:
+            self.delete_many([path for path, exc_info in results if exc_info is None])
+            six.reraise(*errors[0])
+        return [path for path, exc_info in results]
+
+    def try_save(self, file_object, quota=None):
+        try:
+            return self.save(file_object, quota), None
+        except Exception:
+            return None, sys.exc_info()
+
+    def is_concurrent(self):
+        return getattr(settings, 'FORM_PREVIEW_FILE_CACHE_CONCURRENT', True)
+
+    def is_async(self):
+        return getattr(settings, 'FORM_PREVIEW_FILE_CACHE_ASYNC', False)
+
+    def write(self, file_object, path, quota=None):
+        if self.is_async():
+            return self.write_async(file_object, path, quota)
+        return self.write_sync(file_object, path, quota)
+
+    def write_async(self, file_object, path, quota=None):
+        """
+        Spools the upload to a local file that outlives the request and
+        moves it to the storage in a worker thread.
+        """
+        spool_path = self.spool(file_object, quota)
+        with _pending_writes_lock:
+            _pending_writes[path] = get_background_pool().apply_async(self.write_spooled, (spool_path, path))
         return path
 
+    def spool(self, file_object, quota=None):
+        fd, spool_path = tempfile.mkstemp(suffix='.upload', dir=settings.FILE_UPLOAD_TEMP_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as spool:
+                if hasattr(file_object, 'temporary_file_path'):
+                    if quota is not None:
+                        quota.consume(file_object, file_object.size)
+                    with open(file_object.temporary_file_path(), 'rb') as f:
+                        shutil.copyfileobj(f, spool, self.get_chunk_size())
+                else:
+                    for chunk in ChunkedFile(file_object, self.get_chunk_size(), quota).chunks():
+                        spool.write(chunk)
+        except QuotaExceeded:
+            os.remove(spool_path)
+            raise
+        return spool_path
+
+    def write_spooled(self, spool_path, path):
+        try:
+            return self.store_spooled(spool_path, path)
+        except Exception as e:
+            with _pending_writes_lock:
+                _failed_writes[path] = e
+            raise
+        finally:
+            with _pending_writes_lock:
+                _pending_writes.pop(path, None)
+
+    def store_spooled(self, spool_path, path):
+        try:
+            with open(spool_path, 'rb') as f:
+                return self.write_sync(File(f, name=path), path)
+        finally:
+            os.remove(spool_path)
+
+    def is_pending(self, path):
+        return path in _pending_writes
+
+    def wait(self, paths, timeout=None, fail_silently=False):
+        """
+        Waits for pending asynchronous writes of the paths to finish, and
+        raises their exceptions, if any. Each failure is raised once, even
+        if the write had finished before.
+        """
+        for path in paths:
+            result = _pending_writes.get(path)
+            if result is not None:
+                try:
+                    result.get(timeout)
+                except TimeoutError:
+                    raise
+                except Exception:
+                    # Recorded before the write finished; raised below.
+                    pass
+            with _pending_writes_lock:
+                error = _failed_writes.pop(path, None)
+            if error is not None and not fail_silently:
+                raise error
+
+    def write_sync(self, file_object, path, quota=None):
+        if hasattr(file_object, 'temporary_file_path'):
+            if quota is not None:
+                # Already on the local disk in full; only its size counts.
+                quota.consume(file_object, file_object.size)
+            if self.link(file_object, path):
+                return path
+        else:
+            file_object = ChunkedFile(file_object, self.get_chunk_size(), quota)
+        try:
+            return self._storage.save(path, file_object)
+        except QuotaExceeded:
+            # Remove what has been streamed before the upload was aborted.
+            self._storage.delete(path)
+            raise
+
+    def link(self, file_object, path):
+        """
+        Hardlinks a temporary upload into the storage without copying it.
+        Returns False when the storage or filesystem can't do that.
+        """
+        if not hasattr(file_object, 'temporary_file_path') or not hasattr(os, 'link'):
+            return False
+        try:
+            full_path = self._storage.path(path)
+        except NotImplementedError:
+            return False
+
+        directory = os.path.dirname(full_path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return False
+        try:
+            os.link(file_object.temporary_file_path(), full_path)
+        except OSError:
+            return False
+
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:
+            os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
+        return True
+
+    def get_thumbnail_size(self):
+        return getattr(settings, 'FORM_PREVIEW_THUMBNAIL_SIZE', None)
+
+    def get_thumbnail_path(self, path):
+        """
+        Returns the path of the thumbnail of an image, or None when there is
+        none to make.
+        """
+        root, ext = os.path.splitext(path)
+        if (Image is None or not self.get_thumbnail_size() or
+                ext.lower() not in THUMBNAIL_EXTENSIONS or root.endswith(THUMBNAIL_SUFFIX)):
+            return None
+        return root + THUMBNAIL_SUFFIX + ext
+
+    def get_source_path(self, path):
+        """
+        Returns the path of the file a thumbnail was made from.
+        """
+        root, ext = os.path.splitext(path)
+        if root.endswith(THUMBNAIL_SUFFIX):
+            return root[:-len(THUMBNAIL_SUFFIX)] + ext
+        return path
+
+    def with_thumbnails(self, paths):
+        thumbnail_paths = [self.get_thumbnail_path(path) for path in paths]
+        return list(paths) + [path for path in thumbnail_paths if path is not None]
+
+    def derive(self, file_object, path):
+        """
+        Makes the thumbnail of a newly saved image, in a worker thread when
+        the writes or ``FORM_PREVIEW_THUMBNAIL_ASYNC`` are asynchronous.
+        """
+        thumbnail_path = self.get_thumbnail_path(path)
+        if thumbnail_path is None:
+            return
+        if self.is_async() or getattr(settings, 'FORM_PREVIEW_THUMBNAIL_ASYNC', False):
+            with _pending_writes_lock:
+                _pending_writes[thumbnail_path] = get_background_pool().apply_async(
+                    self.create_stored_thumbnail, (path, thumbnail_path)
+                )
+        elif file_object.closed:
+            # Storages may have moved and closed a temporary upload.
+            self.create_stored_thumbnail(path, thumbnail_path)
+        else:
+            self.create_thumbnail(file_object, thumbnail_path)
+
+    def create_stored_thumbnail(self, path, thumbnail_path):
+        try:
+            self.wait([path])
+            file_object = self._storage.open(path)
+            try:
+                return self.create_thumbnail(file_object, thumbnail_path)
+            finally:
+                file_object.close()
+        finally:
+            with _pending_writes_lock:
+                _pending_writes.pop(thumbnail_path, None)
+
+    def create_thumbnail(self, file_object, thumbnail_path):
+        """
+        Saves a downscaled copy of an image. Files that aren't images which
+        PIL can read get no thumbnail.
+        """
+        try:
+            file_object.seek(0)
+            image = Image.open(file_object)
+            image_format = image.format
+            image.thumbnail(self.get_thumbnail_size(), Image.ANTIALIAS)
+            if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            output = BytesIO()
+            image.save(output, image_format, quality=getattr(settings, 'FORM_PREVIEW_THUMBNAIL_QUALITY', 85))
+        except (IOError, ValueError, SyntaxError):
+            return None
+        saved_path = self._storage.save(thumbnail_path, ContentFile(output.getvalue()))
+        if saved_path != thumbnail_path:
+            # Made concurrently for the same file by another request.
+            self._storage.delete(saved_path)
+        return thumbnail_path
+
+    def get_chunk_size(self):
+        return getattr(settings, 'FORM_PREVIEW_FILE_CHUNK_SIZE', File.DEFAULT_CHUNK_SIZE)
+
     def get_upload_tmp_dir_path(self):
         return getattr(settings, 'FORM_PREVIEW_UPLOAD_TMP_DIR', 'formpreview/')
 
+    def get_digest(self, file_object):
+        digest = hashlib.new(self.hash_algorithm)
+        for chunk in file_object.chunks(self.get_chunk_size()):
+            digest.update(chunk)
+        return digest.hexdigest()
+
     def create_filepath(self, file_object):
         root, ext = os.path.splitext(file_object.name)
         name = str(uuid.uuid4())
         return self.get_upload_tmp_dir_path() + name + ext
 
-    def load(self, path):
-        file_object = self._storage.open(path)
-        url = self._storage.url(path)
-        path = self._storage.path(path)
-        return CachedFile(file_object, url, path)
+    def load(self, path, file_object=None):
+        if file_object is not None and file_object.closed:
+            file_object = None
+        return CachedFile(self._storage, path, file_object, self.get_thumbnail_path(path))
 
     def delete(self, path):
-        self._storage.delete(path)
+        self.purge(path)
+
+    def delete_many(self, paths):
+        self.purge_many(paths)
+
+    def purge(self, path):
+        """
+        Deletes a file, and its thumbnail, regardless of who may still be
+        referencing it.
+        """
+        paths = self.with_thumbnails([path])
+        self.wait(paths, fail_silently=True)
+        for path in paths:
+            self._storage.delete(path)
+
+    def purge_many(self, paths):
+        paths = self.with_thumbnails(paths)
+        self.wait(paths, fail_silently=True)
+        if hasattr(self._storage, 'delete_many'):
+            # Storages with a bulk delete call (e.g. S3 multi-object delete).
+            self._storage.delete_many(paths)
+        elif len(paths) == 1:
+            self._storage.delete(paths[0])
+        elif paths:
+            get_thread_pool().map(self._storage.delete, paths)
+
+    def list_files(self, directory=None):
+        if directory is None:
+            directory = self.get_upload_tmp_dir_path()
+        try:
+            directories, files = self._storage.listdir(directory)
+        except OSError:
+            return
+        for name in files:
+            yield os.path.join(directory, name)
+        for name in directories:
+            for path in self.list_files(os.path.join(directory, name)):
+                yield path
+
+    def modified_time(self, path):
+        return self._storage.modified_time(path)
+
+
+class HashedFileCache(FileCache):
+    """
+    A file cache that names files by the hash of their content, so identical
+    uploads share one stored file. Stored files are reference counted and
+    deleted when the last reference is released.
+    """
+    _refs = lazy_cache_backend()
+
+    def save(self, file_object, quota=None):
+        path = self.create_filepath(file_object)
+        self.add_reference(path)
+        try:
+            if not self.is_pending(path) and not self._storage.exists(path):
+                saved_path = self.write(file_object, path, quota)
+                if saved_path != path:
+                    # Another request stored the same content concurrently.
+                    self._storage.delete(saved_path)
+                else:
+                    self.derive(file_object, path)
+            elif quota is not None:
+                quota.consume(file_object, file_object.size)
+        except QuotaExceeded:
+            self.release_reference(path)
+            raise
+        return path
+
+    def store_spooled(self, spool_path, path):
+        saved_path = super(HashedFileCache, self).store_spooled(spool_path, path)
+        if saved_path != path:
+            # Another request stored the same content concurrently.
+            self._storage.delete(saved_path)
+        return path
+
+    def create_filepath(self, file_object):
+        root, ext = os.path.splitext(file_object.name)
+        return self.get_upload_tmp_dir_path() + self.get_digest(file_object) + ext.lower()
+
+    def get_reference_key(self, path):
+        return 'formpreview-ref:' + path
+
+    def get_reference_timeout(self):
+        return getattr(settings, 'FORM_PREVIEW_FILE_REFERENCE_TIMEOUT', 7 * 24 * 60 * 60)
+
+    def add_reference(self, path):
+        key = self.get_reference_key(path)
+        timeout = self.get_reference_timeout()
+        if self._refs.add(key, 1, timeout):
+            return 1
+        try:
+            return self._refs.incr(key)
+        except ValueError:
+            self._refs.set(key, 1, timeout)
+            return 1
+
+    def release_reference(self, path):
+        """
+        Returns True when the last reference to the path was released.
+        """
+        try:
+            return self._refs.decr(self.get_reference_key(path)) <= 0
+        except ValueError:
+            # The count is gone; leave the file for the sweeper rather than
+            # risk deleting a file that is still referenced.
+            return False
+
+    def delete(self, path):
+        if self.release_reference(path):
+            self.purge(path)
+
+    def delete_many(self, paths):
+        self.purge_many([path for path in paths if self.release_reference(path)])
+
+    def purge(self, path):
+        self._refs.delete(self.get_reference_key(path))
+        super(HashedFileCache, self).purge(path)
+
+    def purge_many(self, paths):
+        paths = list(paths)
+        self._refs.delete_many([self.get_reference_key(path) for path in paths])
+        super(HashedFileCache, self).purge_many(paths)
+
+
+def get_file_cache_class(import_path=None):
+    if not import_path:
+        import_path = getattr(settings, 'FORM_PREVIEW_FILE_CACHE', 'formpreview.files.FileCache')
+    return import_by_path(import_path)
+
+
+class ChunkedFile(File):
+    """
+    Wraps an upload so storages stream it in chunks of a bounded size,
+    counting the streamed bytes against a quota, if any.
+    """
+    def __init__(self, file_object, chunk_size, quota=None):
+        super(ChunkedFile, self).__init__(file_object, file_object.name)
+        self.DEFAULT_CHUNK_SIZE = chunk_size
+        self.quota = quota
+
+    def chunks(self, chunk_size=None):
+        for chunk in super(ChunkedFile, self).chunks(chunk_size):
+            if self.quota is not None:
+                self.quota.consume(self.file, len(chunk))
+            yield chunk
 
 
 class CachedFile(File):
-    def __init__(self, file_object, url, path):
-        self.import_properties(file_object)
-        self.url = url
-        self.path = path
-        self.name = url.replace(settings.MEDIA_URL, '')
-
-    def import_properties(self, file_object):
-        self.__dict__ = file_object.__dict__.copy()
+    """
+    A file in the preview cache, opened from storage on first read.
+    """
+    def __init__(self, storage, name, file_object=None, thumbnail_name=None):
+        self.storage = storage
+        self.name = name
+        self.thumbnail_name = thumbnail_name
+        self._file = file_object
+        if file_object is not None:
+            file_object.seek(0)
+
+    def _get_file(self):
+        if self._file is None:
+            self._file = self.storage.open(self.name)
+        return self._file
+
+    def _set_file(self, file_object):
+        self._file = file_object
+
+    file = property(_get_file, _set_file)
+
+    def _get_size(self):
+        if self._file is None and not hasattr(self, '_size'):
+            self._size = self.storage.size(self.name)
+        return super(CachedFile, self)._get_size()
+
+    size = property(_get_size, File._set_size)
+
+    @property
+    def closed(self):
+        return self._file is None or self._file.closed
+
+    @cached_property
+    def url(self):
+        return self.storage.url(self.name)
+
+    @cached_property
+    def path(self):
+        return self.storage.path(self.name)
+
+    @cached_property
+    def thumbnail(self):
+        """
+        The downscaled copy of an image, or None until there is one.
+        """
+        if self.thumbnail_name is None or not self.storage.exists(self.thumbnail_name):
+            return None
+        return CachedFile(self.storage, self.thumbnail_name)
+
+    def open(self, mode='rb'):
+        if self.closed:
+            self._file = self.storage.open(self.name, mode)
+        else:
+            self.seek(0)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from formpreview import benchmarks
+
+
+class Command(NoArgsCommand):
+    help = 'Benchmarks the input, preview and post stages of the form views.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--iterations', type='int', dest='iterations', default=20,
+                    help='Number of times each scenario is run.'),
+        make_option('--baseline', dest='baseline', default=None,
+                    help='Path of a baseline to compare the results against.'),
+        make_option('--save-baseline', dest='save_baseline', default=None,
+                    help='Path to save the results to, as a new baseline.'),
+        make_option('--calls-only', action='store_false', dest='latency', default=True,
+                    help='Leave the machine-specific latencies out of the saved baseline.'),
+        make_option('--tolerance', type='float', dest='tolerance', default=0.25,
+                    help='Allowed latency growth over the baseline, as a fraction.'),
+    )
+
+    def handle_noargs(self, **options):
+        results = benchmarks.run(iterations=options['iterations'])
+
+        for name, result in sorted(results.items()):
+            self.stdout.write(name)
+            for stage in benchmarks.STAGES:
+                latency = result['latency'][stage]
+                calls = ', '.join('%s=%d' % item for item in sorted(result['calls'][stage].items()))
+                self.stdout.write('  %-8s p50=%.2fms p90=%.2fms p99=%.2fms  %s' % (
+                    stage, latency['p50'], latency['p90'], latency['p99'], calls))
+            self.stdout.write('  retained objects per iteration: %d' % result['retained_objects'])
+
+        if options['save_baseline']:
+            benchmarks.save_baseline(results, options['save_baseline'], options['latency'])
+
+        if options['baseline']:
+            regressions = benchmarks.compare(
+                results, benchmarks.load_baseline(options['baseline']), options['tolerance']
+            )
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError('%d regression(s) against the baseline.' % len(regressions))
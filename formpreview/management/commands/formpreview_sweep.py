@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from formpreview.cache import get_post_cache_class
+from formpreview.cache.base import PostCacheBase, get_cache_timeout
+from formpreview.sweeper import sweep
+
+
+class Command(NoArgsCommand):
+    help = ('Deletes expired post cache entries, orphaned files and chunks of uploads '
+            'left behind by abandoned previews.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report the files that would be deleted.'),
+        make_option('--expires', type='int', dest='expires', default=None,
+                    help='Age in seconds after which an unowned file is deleted.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Number of files handled per batch.'),
+        make_option('--throttle', type='float', dest='throttle', default=0,
+                    help='Seconds to sleep between batches.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options['verbosity'])
+        post_cache_class = get_post_cache_class()
+        if not options['dry_run']:
+            if hasattr(post_cache_class, 'delete_expired'):
+                post_cache_class.delete_expired()
+            expires = options['expires'] if options['expires'] is not None else get_cache_timeout()
+            PostCacheBase.upload_registry.sweep_spool(expires)
+
+        report = sweep(
+            dry_run=options['dry_run'],
+            expires=options['expires'],
+            batch_size=options['batch_size'],
+            throttle=options['throttle'],
+        )
+        if verbosity >= 2:
+            for path, modified in report:
+                self.stdout.write('%s (%s)' % (path, modified.isoformat()))
+        if options['dry_run']:
+            self.stdout.write('%d file(s) would be deleted.' % len(report))
+        else:
+            self.stdout.write('%d file(s) deleted.' % len(report))
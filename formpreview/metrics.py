@@ -0,0 +1,132 @@
+from collections import defaultdict
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_by_path
+
+
+class Timer(object):
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.collector.timing(self.name, (time.time() - self.start) * 1000)
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullCollector(object):
+    """
+    Discards all metrics. The default, so instrumentation costs next to
+    nothing unless a collector is configured.
+    """
+    enabled = False
+    _timer = NullTimer()
+
+    def timer(self, name):
+        return self._timer
+
+    def timing(self, name, milliseconds):
+        pass
+
+    def incr(self, name, count=1):
+        pass
+
+    def histogram(self, name, value):
+        pass
+
+
+class Collector(NullCollector):
+    enabled = True
+
+    def timer(self, name):
+        return Timer(self, name)
+
+
+class MemoryCollector(Collector):
+    """
+    Keeps counters and per-name summaries in the process, e.g. for tests or
+    for a Prometheus exporter to scrape.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.values = defaultdict(list)
+
+    def timing(self, name, milliseconds):
+        with self._lock:
+            self.values[name].append(milliseconds)
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+
+    def histogram(self, name, value):
+        with self._lock:
+            self.values[name].append(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'summaries': dict(
+                    (name, {'count': len(values), 'sum': sum(values)})
+                    for name, values in self.values.items()
+                ),
+            }
+
+
+class StatsdCollector(Collector):
+    """
+    Sends metrics to a StatsD server over UDP. Errors are ignored.
+    """
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (
+            host or getattr(settings, 'FORM_PREVIEW_STATSD_HOST', 'localhost'),
+            port or getattr(settings, 'FORM_PREVIEW_STATSD_PORT', 8125),
+        )
+        self.prefix = prefix or getattr(settings, 'FORM_PREVIEW_STATSD_PREFIX', 'formpreview')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind):
+        try:
+            self.socket.sendto('%s.%s:%s|%s' % (self.prefix, name, value, kind), self.address)
+        except (socket.error, socket.gaierror):
+            pass
+
+    def timing(self, name, milliseconds):
+        self.send(name, '%.3f' % milliseconds, 'ms')
+
+    def incr(self, name, count=1):
+        self.send(name, count, 'c')
+
+    def histogram(self, name, value):
+        self.send(name, value, 'h')
+
+
+_collectors = {}
+
+
+def get_collector(import_path=None):
+    if not import_path:
+        import_path = getattr(settings, 'FORM_PREVIEW_METRICS_COLLECTOR', 'formpreview.metrics.NullCollector')
+    if import_path not in _collectors:
+        _collectors[import_path] = import_by_path(import_path)()
+    return _collectors[import_path]
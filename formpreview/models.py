@@ -0,0 +1,8 @@
+from django.db import models
+
+
+class PostCacheEntry(models.Model):
+    key = models.CharField(max_length=255, primary_key=True)
+    value = models.BinaryField()
+    expires_at = models.DateTimeField(db_index=True)
+    version = models.IntegerField(default=0)
@@ -0,0 +1,156 @@
+# coding=utf8
+from __future__ import unicode_literals
+
+from django import forms
+from django.forms.forms import pretty_name
+from django.forms.models import ModelChoiceField, ModelMultipleChoiceField
+from django.utils.encoding import force_text, python_2_unicode_compatible
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+
+from .backends import LazyBackend
+from .metrics import get_collector
+
+
+def render_text(field, value):
+    return force_text(value) if value is not None else ''
+
+
+def render_file(field, value):
+    if not value:
+        return ''
+    try:
+        url = value.url
+    except ValueError:
+        # A FieldFile without a file.
+        return ''
+    return format_html('<a href="{0}">{1}</a>', url, value.name)
+
+
+def render_image(field, value):
+    if not value:
+        return ''
+    try:
+        url = value.url
+    except ValueError:
+        return ''
+    thumbnail = getattr(value, 'thumbnail', None)
+    if thumbnail is not None:
+        return format_html('<a href="{0}"><img src="{1}" alt="{2}"></a>', url, thumbnail.url, value.name)
+    return format_html('<img src="{0}" alt="{1}">', url, value.name)
+
+
+def _flatten_choices(choices):
+    for key, label in choices:
+        if isinstance(label, (list, tuple)):
+            for option in _flatten_choices(label):
+                yield option
+        else:
+            yield force_text(key), label
+
+
+def render_choice(field, value):
+    if value in (None, ''):
+        return ''
+    return force_text(dict(_flatten_choices(field.choices)).get(force_text(value), value))
+
+
+def render_multiple_choice(field, value):
+    choices = dict(_flatten_choices(field.choices))
+    return ', '.join(force_text(choices.get(force_text(v), v)) for v in value or [])
+
+
+def render_model_multiple_choice(field, value):
+    return ', '.join(force_text(v) for v in value or [])
+
+
+def get_renderer(field):
+    if isinstance(field, forms.ImageField):
+        return render_image
+    if isinstance(field, forms.FileField):
+        return render_file
+    if isinstance(field, ModelMultipleChoiceField):
+        return render_model_multiple_choice
+    if isinstance(field, ModelChoiceField):
+        return render_text
+    if isinstance(field, forms.MultipleChoiceField):
+        return render_multiple_choice
+    if isinstance(field, forms.ChoiceField):
+        return render_choice
+    return render_text
+
+
+def get_signature(fields):
+    """
+    Returns what a plan depends on: the names and classes of the fields,
+    and whether their widgets are hidden.
+    """
+    return tuple((name, field.__class__, field.widget.is_hidden) for name, field in fields.items())
+
+
+class PreviewPlan(object):
+    """
+    The fields to preview, in order, with a renderer for each of them.
+    """
+    def __init__(self, fields):
+        self.signature = get_signature(fields)
+        self.rows = [
+            (name, get_renderer(field)) for name, field in fields.items()
+            if not field.widget.is_hidden
+        ]
+
+
+# Plans built from the declared fields of each form class.
+_plans = {}
+
+
+def get_plan(form):
+    plan = _plans.get(form.__class__)
+    if plan is None:
+        plan = _plans.setdefault(form.__class__, PreviewPlan(form.base_fields))
+    if plan.signature != get_signature(form.fields):
+        # The form changed its fields or widgets at runtime.
+        return PreviewPlan(form.fields)
+    return plan
+
+
+@python_2_unicode_compatible
+class FormPreview(object):
+    """
+    Renders the values of a valid form for the preview stage.
+    """
+    table_row = '<tr><th>{0}</th><td>{1}</td></tr>'
+    ul_row = '<li>{0}: {1}</li>'
+    p_row = '<p>{0}: {1}</p>'
+    metrics = LazyBackend(get_collector, 'FORM_PREVIEW_METRICS_COLLECTOR')
+
+    def __init__(self, form):
+        self.form = form
+        self.plan = get_plan(form)
+
+    def __str__(self):
+        return self.as_table()
+
+    def rows(self):
+        form = self.form
+        cleaned_data = getattr(form, 'cleaned_data', {})
+        for name, renderer in self.plan.rows:
+            field = form.fields[name]
+            if name in cleaned_data:
+                value = cleaned_data[name]
+            else:
+                value = form[name].value()
+            yield field.label or pretty_name(name), renderer(field, value)
+
+    def render(self, row_template):
+        with self.metrics.timer('preview.render'):
+            return format_html_join(mark_safe('\n'), row_template, self.rows())
+
+    def as_table(self):
+        return self.render(self.table_row)
+
+    def as_ul(self):
+        return self.render(self.ul_row)
+
+    def as_p(self):
+        return self.render(self.p_row)
@@ -0,0 +1,87 @@
+from collections import defaultdict
+import threading
+
+from django.conf import settings
+from django.template.defaultfilters import filesizeformat
+from django.utils.encoding import force_bytes
+
+
+class QuotaExceeded(ValueError):
+    def __init__(self, message, field=None):
+        super(QuotaExceeded, self).__init__(message)
+        self.message = message
+        self.field = field
+
+
+class Quota(object):
+    """
+    Limits the size and number of the files and data cached for one
+    submission. Sizes are counted while the files are streamed, so an
+    oversized upload is aborted before it is stored in full.
+    """
+    def __init__(self, max_field_size=None, max_field_files=None, max_size=None, max_files=None,
+                 max_data_size=None):
+        self.max_field_size = self.get_limit(max_field_size, 'FORM_PREVIEW_MAX_FIELD_SIZE')
+        self.max_field_files = self.get_limit(max_field_files, 'FORM_PREVIEW_MAX_FIELD_FILES')
+        self.max_size = self.get_limit(max_size, 'FORM_PREVIEW_MAX_UPLOAD_SIZE')
+        self.max_files = self.get_limit(max_files, 'FORM_PREVIEW_MAX_FILES')
+        self.max_data_size = self.get_limit(max_data_size, 'FORM_PREVIEW_MAX_DATA_SIZE')
+        self.error = None
+        self._fields = {}
+        self._field_sizes = defaultdict(int)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get_limit(self, value, setting):
+        return value if value is not None else getattr(settings, setting, None)
+
+    def check_data(self, data):
+        size = sum(
+            len(force_bytes(key)) + len(force_bytes(value))
+            for key, values in data.lists() for value in values
+        )
+        if self.max_data_size is not None and size > self.max_data_size:
+            raise QuotaExceeded('The submitted data must be at most %s.' % filesizeformat(self.max_data_size))
+
+    def check_files(self, files):
+        """
+        Checks the number and the reported sizes of the uploads before any
+        of them is saved.
+        """
+        count = sum(len(values) for key, values in files.lists())
+        if self.max_files is not None and count > self.max_files:
+            raise QuotaExceeded('At most %d files can be uploaded.' % self.max_files)
+
+        size = 0
+        for field, values in files.lists():
+            if self.max_field_files is not None and len(values) > self.max_field_files:
+                raise QuotaExceeded('At most %d files can be uploaded.' % self.max_field_files, field)
+            field_size = 0
+            for value in values:
+                self._fields[id(value)] = field
+                field_size += getattr(value, 'size', None) or 0
+            size += field_size
+            self.check_size(field, field_size, size)
+
+    def consume(self, file_object, size):
+        """
+        Counts ``size`` more bytes of the file being saved.
+        """
+        with self._lock:
+            if self.error is not None:
+                # Another file of the submission has been rejected already.
+                raise self.error
+            field = self._fields.get(id(file_object))
+            self._field_sizes[field] += size
+            self._size += size
+            try:
+                self.check_size(field, self._field_sizes[field], self._size)
+            except QuotaExceeded as e:
+                self.error = e
+                raise
+
+    def check_size(self, field, field_size, size):
+        if self.max_field_size is not None and field_size > self.max_field_size:
+            raise QuotaExceeded('The files must be at most %s.' % filesizeformat(self.max_field_size), field)
+        if self.max_size is not None and size > self.max_size:
+            raise QuotaExceeded('The uploaded files must be at most %s in total.' % filesizeformat(self.max_size))
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+import time
+
+from .cache.base import PostCacheBase, get_cache_timeout
+
+
+class Sweeper(object):
+    """
+    Deletes cached files that no post cache entry owns any more.
+
+    A file is swept when its ownership record in the file registry has
+    expired and it has not been modified for ``expires`` seconds.
+    """
+    def __init__(self, file_cache=None, file_registry=None, expires=None, batch_size=100, throttle=0):
+        self.file_cache = file_cache or PostCacheBase.file_cache
+        self.file_registry = file_registry or PostCacheBase.file_registry
+        self.expires = expires if expires is not None else get_cache_timeout()
+        self.batch_size = batch_size
+        self.throttle = throttle
+
+    def iter_batches(self):
+        batch = []
+        for path in self.file_cache.list_files():
+            batch.append(path)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def find_expired(self, paths):
+        cutoff = datetime.now() - timedelta(seconds=self.expires)
+        # Thumbnails belong to whoever owns the file they were made from.
+        sources = dict((path, self.file_cache.get_source_path(path)) for path in paths)
+        owners = self.file_registry.get_owners(set(sources.values()))
+        expired = []
+        for path in paths:
+            if sources[path] in owners:
+                continue
+            modified = self.file_cache.modified_time(path)
+            if modified < cutoff:
+                expired.append((path, modified))
+        return expired
+
+    def sweep(self, dry_run=False):
+        """
+        Returns a list of (path, modified_time) for the swept files.
+        """
+        report = []
+        for paths in self.iter_batches():
+            expired = self.find_expired(paths)
+            report.extend(expired)
+            if dry_run or not expired:
+                continue
+            for path, modified in expired:
+                self.file_cache.purge(path)
+            if self.throttle:
+                time.sleep(self.throttle)
+        return report
+
+
+def sweep(dry_run=False, **kwargs):
+    return Sweeper(**kwargs).sweep(dry_run=dry_run)
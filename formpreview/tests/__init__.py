@@ -1,5 +1,16 @@
-from cache import PostCacheBaseTest  # NOQA
-from files import FileCacheTest  # NOQA
-from views import FormView  # NOQA
+from backends import BackendTest  # NOQA
+from benchmarks import BenchmarkTest  # NOQA
+from cache import ConcurrentSaveTest, IncrementalSaveTest, PostCacheBaseTest  # NOQA
+from db import DatabasePostCacheTest  # NOQA
+from files import FileCacheTest, FileSystemFileCacheTest, HashedFileCacheTest, ThumbnailTest  # NOQA
+from local import LocalCachePostCacheTest, LocalCacheTest  # NOQA
+from metrics import MetricsTest  # NOQA
+from preview import FormPreviewTest  # NOQA
+from quotas import QuotaTest  # NOQA
+from serializers import CompactSerializerTest  # NOQA
+from signed import SignedPostCacheTest  # NOQA
+from sweeper import SweeperTest  # NOQA
+from uploads import ChunkedUploadTest  # NOQA
+from views import CleanedDataTest, FormClassTest, FormViewTest, ValidateFirstTest  # NOQA
 
-__all__ = ['FormView', ' FileCacheTest', 'PostCacheBaseTest']
+__all__ = ['BackendTest', 'BenchmarkTest', 'ChunkedUploadTest', 'CleanedDataTest', 'CompactSerializerTest', 'ConcurrentSaveTest', 'DatabasePostCacheTest', 'FormClassTest', 'FormPreviewTest', 'FormViewTest', 'FileCacheTest', 'FileSystemFileCacheTest', 'HashedFileCacheTest', 'IncrementalSaveTest', 'LocalCachePostCacheTest', 'LocalCacheTest', 'MetricsTest', 'PostCacheBaseTest', 'QuotaTest', 'SignedPostCacheTest', 'SweeperTest', 'ThumbnailTest', 'ValidateFirstTest']
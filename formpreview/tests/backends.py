@@ -0,0 +1,38 @@
+from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import Mock
+
+from ..backends import LazyBackend
+from ..cache.local import LocalCachePostCache
+from views import SampleView
+
+
+class BackendTest(TestCase):
+    def test_lazy(self):
+        factory = Mock(side_effect=lambda: object())
+
+        class Sample(object):
+            backend = LazyBackend(factory, 'FORM_PREVIEW_SAMPLE_BACKEND')
+
+        self.assertEqual(factory.call_count, 0)
+        backend = Sample.backend
+        self.assertTrue(Sample().backend is backend)
+        self.assertEqual(factory.call_count, 1)
+
+        with self.settings(FORM_PREVIEW_OTHER_BACKEND='other'):
+            self.assertTrue(Sample.backend is backend)
+        with self.settings(FORM_PREVIEW_SAMPLE_BACKEND='sample'):
+            self.assertFalse(Sample.backend is backend)
+        self.assertFalse(Sample.backend is backend)
+        self.assertEqual(factory.call_count, 3)
+
+    def test_view_override(self):
+        request = RequestFactory().get('/')
+        view = SampleView(request=request, post_cache_class='formpreview.cache.local.LocalCachePostCache')
+        self.assertTrue(view.get_post_cache_class() is LocalCachePostCache)
+        view = SampleView(request=request, post_cache_class=LocalCachePostCache)
+        self.assertTrue(view.get_post_cache_class() is LocalCachePostCache)
+
+        with self.settings(FORMPREVIEW_CACHE_BACKEND='formpreview.cache.local.LocalCachePostCache'):
+            self.assertTrue(SampleView(request=request).get_post_cache_class() is LocalCachePostCache)
+        self.assertFalse(SampleView(request=request).get_post_cache_class() is LocalCachePostCache)
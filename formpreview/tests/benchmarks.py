@@ -0,0 +1,39 @@
+import os
+
+from django.test import TestCase
+
+from .. import benchmarks
+from ..models import PostCacheEntry
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+
+class BenchmarkTest(TestCase):
+    def test_backend_calls(self, *args, **kwargs):
+        results = benchmarks.run(iterations=1)
+        self.assertEqual(sorted(results), sorted(s['name'] for s in benchmarks.SCENARIOS))
+        for result in results.values():
+            self.assertEqual(sorted(result['latency']), sorted(benchmarks.STAGES))
+
+        regressions = benchmarks.compare(results, benchmarks.load_baseline(BASELINE_PATH), latency=False)
+        self.assertEqual(regressions, [])
+
+    def test_compare(self, *args, **kwargs):
+        baseline = {'form': {
+            'calls': {'preview': {'cache.get': 1}},
+            'latency': {'preview': {'p50': 10.0}},
+        }}
+        results = {'form': {
+            'calls': {'preview': {'cache.get': 2}},
+            'latency': {'preview': {'p50': 20.0}},
+        }}
+        self.assertEqual(len(benchmarks.compare(results, baseline)), 2)
+        self.assertEqual(len(benchmarks.compare(results, baseline, latency=False)), 1)
+        self.assertEqual(benchmarks.compare(baseline, baseline), [])
+        del baseline['form']['latency']
+        self.assertEqual(len(benchmarks.compare(results, baseline)), 1)
+
+    def test_rolls_back(self, *args, **kwargs):
+        benchmarks.run([s for s in benchmarks.SCENARIOS if s['view'] != 'form'], iterations=1)
+        self.assertEqual(PostCacheEntry.objects.count(), 0)
@@ -1,9 +1,16 @@
+import shutil
+import tempfile
+import time
+
 from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
 from django.test import TestCase
+from django.test.client import RequestFactory
 from django.utils.datastructures import MultiValueDict
-from mock import patch
+from mock import Mock, patch
 
-from ..cache.base import PostCacheBase
+from ..cache import CachePostCache
+from ..cache.base import PostCacheBase, PostCacheConflict
 from ..files import CachedFile
 
 
@@ -13,7 +20,10 @@ class PostCacheBaseTest(TestCase):
         self.patchers.append(
             patch('formpreview.cache.base.PostCacheBase.file_cache', **{
                 'save.return_value': '/path/to/filename',
-                'load.return_value': CachedFile(ContentFile(''), '/path/to/filename', '/path/to/filename'),
+                'save_many.side_effect': lambda file_objects, quota=None: ['/path/to/filename' for f in file_objects],
+                'load.return_value': CachedFile(
+                    Mock(**{'url.return_value': '/path/to/filename'}), '/path/to/filename'
+                ),
                 'delete.return_value': None,
             })
         )
@@ -26,8 +36,7 @@ class PostCacheBaseTest(TestCase):
             })
         )
         self.patchers.append(patch('formpreview.cache.base.PostCacheBase.set_cache'))
-        for p in self.patchers:
-            p.start()
+        self.mocks = [p.start() for p in self.patchers]
         self.cache = PostCacheBase('key')
 
     def tearDown(self):
@@ -39,6 +48,20 @@ class PostCacheBaseTest(TestCase):
         self.assertTrue(isinstance(self.cache.FILES, MultiValueDict))
         self.assertEqual(len(self.cache.POST), 2)
 
+    def test_lazy_load(self, *args, **kwargs):
+        get_cache = self.mocks[1]
+        self.assertEqual(get_cache.call_count, 0)
+        self.cache.POST
+        self.cache.FILES
+        self.assertEqual(get_cache.call_count, 1)
+
+    def test_new_key(self, *args, **kwargs):
+        get_cache = self.mocks[1]
+        cache = PostCacheBase('new-key', new=True)
+        self.assertEqual(len(cache.POST), 0)
+        self.assertEqual(len(cache.FILES), 0)
+        self.assertEqual(get_cache.call_count, 0)
+
     def test_load_files(self, *args, **kwargs):
         files = self.cache.load_files(MultiValueDict({'hoge': ['/path/to/filename']}))
         self.assertTrue(isinstance(files, MultiValueDict))
@@ -59,3 +82,202 @@ class PostCacheBaseTest(TestCase):
     def test_delete_files(self, *args, **kwargs):
         result = self.cache.delete_files(MultiValueDict({'hoge': ['/path/to/filename']}))
         self.assertEqual(result, None)
+
+    def test_save_round_trips(self, *args, **kwargs):
+        file_cache, get_cache, set_cache = self.mocks
+        upload = ContentFile('xxx', name='sample.txt')
+        request = RequestFactory().post('/', {'hoge': 'fuga', 'foo': upload})
+
+        self.cache.save(request)
+        self.cache.POST
+        self.cache.FILES
+
+        self.assertEqual(get_cache.call_count, 1)
+        self.assertEqual(set_cache.call_count, 1)
+        self.assertEqual(file_cache.save_many.call_count, 1)
+        self.assertEqual(file_cache.load.call_count, 1)
+        path, file_object = file_cache.load.call_args[0]
+        self.assertEqual(path, '/path/to/filename')
+        self.assertEqual(file_object.name, 'sample.txt')
+
+    def test_prepare_writes_nothing(self, *args, **kwargs):
+        file_cache, get_cache, set_cache = self.mocks
+        upload = ContentFile('xxx', name='sample.txt')
+        request = RequestFactory().post('/', {'hoge': 'fuga', 'foo': upload, 'bar': upload})
+
+        self.cache.prepare(request)
+        self.assertEqual(self.cache.POST['hoge'], 'fuga')
+        self.assertEqual(self.cache.FILES['foo'].name, 'sample.txt')
+        self.assertEqual(set_cache.call_count, 0)
+        self.assertEqual(file_cache.save_many.call_count, 0)
+        self.assertEqual(file_cache.delete_many.call_count, 0)
+
+        self.cache.commit(extra='value')
+        self.assertEqual(set_cache.call_count, 1)
+        self.assertEqual(file_cache.save_many.call_count, 1)
+        self.assertEqual(self.cache.extra, {'extra': 'value'})
+
+    def test_save_releases_replaced_files(self, *args, **kwargs):
+        file_cache, get_cache, set_cache = self.mocks
+        file_cache.save_many.side_effect = lambda file_objects, quota=None: ['/path/to/new_filename' for f in file_objects]
+        upload = ContentFile('xxx', name='sample.txt')
+        request = RequestFactory().post('/', {'foo': upload})
+
+        self.cache.save(request)
+        file_cache.delete_many.assert_called_once_with(['/path/to/filename'])
+        self.assertEqual(self.cache._paths.getlist('foo'), ['/path/to/new_filename'])
+
+    def test_clear_round_trips(self, *args, **kwargs):
+        file_cache, get_cache, set_cache = self.mocks
+        with patch('formpreview.cache.base.PostCacheBase.delete_cache') as delete_cache:
+            self.cache.clear()
+            delete_cache.assert_called_once_with('key')
+        self.assertEqual(get_cache.call_count, 1)
+        self.assertEqual(file_cache.load.call_count, 0)
+        file_cache.delete_many.assert_called_once_with(['/path/to/filename'])
+
+    def test_deferred_clear(self, *args, **kwargs):
+        file_cache, get_cache, set_cache = self.mocks
+        with patch('formpreview.cache.base.PostCacheBase.delete_cache') as delete_cache:
+            self.cache.clear(defer=True)
+            delete_cache.assert_called_once_with('key')
+        self.assertEqual(file_cache.delete_many.call_count, 0)
+        self.assertEqual(len(self.cache.FILES), 0)
+        self.cache.close()
+        file_cache.delete_many.assert_called_once_with(['/path/to/filename'])
+        self.cache.close()
+        self.assertEqual(file_cache.delete_many.call_count, 1)
+
+
+class IncrementalSaveTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.patcher = patch('formpreview.files.FileCache._storage', FileSystemStorage(self.location))
+        self.patcher.start()
+        self.settings_override = self.settings(FORM_PREVIEW_INCREMENTAL_SAVE=True)
+        self.settings_override.enable()
+        CachePostCache._cache.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+        CachePostCache._cache.clear()
+
+    def save(self, title):
+        request = RequestFactory().post('/', {'title': title, 'foo': ContentFile('xxx', name='sample.txt')})
+        cache = CachePostCache('key')
+        with patch.object(CachePostCache, 'set_cache_if', wraps=cache.set_cache_if) as set_cache_if:
+            with patch.object(cache.file_cache, 'save_many', wraps=cache.file_cache.save_many) as save_many:
+                cache.save(request)
+        return cache, set_cache_if.call_count, save_many.call_count
+
+    def test_unchanged(self):
+        cache, writes, saves = self.save('hoge')
+        self.assertEqual((cache.version, writes, saves), (1, 1, 1))
+        path = cache.FILES['foo'].name
+
+        cache, writes, saves = self.save('hoge')
+        self.assertEqual((cache.version, writes, saves), (1, 0, 0))
+
+        cache, writes, saves = self.save('fuga')
+        self.assertEqual((cache.version, writes, saves), (2, 1, 0))
+        self.assertEqual(CachePostCache('key').FILES['foo'].name, path)
+        self.assertEqual(list(cache.file_cache.list_files()), [path])
+
+
+class ConcurrentSaveTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.patcher = patch('formpreview.files.FileCache._storage', FileSystemStorage(self.location))
+        self.patcher.start()
+        self.settings_override = self.settings(FORM_PREVIEW_CONFLICT_RETRY_DELAY=0)
+        self.settings_override.enable()
+        CachePostCache._cache.clear()
+        self.save(CachePostCache('key'), {'title': 'hoge', 'foo': ContentFile('foo', name='foo.txt')})
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+        CachePostCache._cache.clear()
+
+    def prepare(self, data):
+        cache = CachePostCache('key')
+        cache.prepare(RequestFactory().post('/', data))
+        return cache
+
+    def save(self, cache, data):
+        cache.prepare(RequestFactory().post('/', data))
+        cache.commit()
+
+    def test_merge(self):
+        first = self.prepare({'title': 'fuga', 'bar': ContentFile('bar', name='bar.txt')})
+        second = self.prepare({'title': 'piyo', 'foo': ContentFile('baz', name='baz.txt')})
+        first.commit()
+        second.commit()
+
+        cache = CachePostCache('key')
+        self.assertEqual(cache.POST['title'], 'piyo')
+        self.assertEqual(cache.version, 3)
+        self.assertEqual(cache.FILES['foo'].read(), 'baz')
+        self.assertEqual(cache.FILES['bar'].read(), 'bar')
+        self.assertEqual(
+            sorted(cache.file_cache.list_files()),
+            sorted([cache.FILES['foo'].name, cache.FILES['bar'].name]),
+        )
+
+    def test_unversioned(self):
+        # Stored before saves were versioned.
+        cache = CachePostCache('key')
+        CachePostCache._cache.set('key', cache.serializer.dumps({
+            'data': MultiValueDict({'title': ['hoge']}), 'files': MultiValueDict(),
+        }))
+        self.save(cache, {'title': 'fuga'})
+        self.assertEqual(CachePostCache('key').POST['title'], 'fuga')
+
+    def test_stranded_claim(self):
+        with self.settings(FORM_PREVIEW_CONFLICT_CLAIM_TIMEOUT=0.1):
+            # The write after the claim is silently dropped.
+            with patch.object(CachePostCache._cache, 'set'):
+                self.save(CachePostCache('key'), {'title': 'fuga'})
+            with self.assertRaises(PostCacheConflict):
+                self.save(CachePostCache('key'), {'title': 'piyo'})
+            time.sleep(0.2)
+            self.save(CachePostCache('key'), {'title': 'piyo'})
+        cache = CachePostCache('key')
+        self.assertEqual(cache.POST['title'], 'piyo')
+        self.assertEqual(cache.version, 2)
+
+    def test_stale_after_claim_expired(self):
+        with self.settings(FORM_PREVIEW_CONFLICT_CLAIM_TIMEOUT=0.1):
+            first = self.prepare({'title': 'fuga'})
+            self.save(CachePostCache('key'), {'title': 'piyo', 'bar': ContentFile('bar', name='bar.txt')})
+            time.sleep(0.2)
+            # The claim of the version it loaded has expired.
+            first.commit()
+        cache = CachePostCache('key')
+        self.assertEqual(cache.POST['title'], 'fuga')
+        self.assertEqual(cache.version, 3)
+        self.assertEqual(cache.FILES['bar'].read(), 'bar')
+
+    def test_evicted(self):
+        cache = CachePostCache('key')
+        self.save(cache, {'title': 'fuga'})
+        CachePostCache._cache.delete('key')
+        # The claims made for the evicted entry are still around.
+        for title in ('piyo', 'hoge'):
+            self.save(CachePostCache('key'), {'title': title})
+        cache = CachePostCache('key')
+        self.assertEqual(cache.POST['title'], 'hoge')
+        self.assertEqual(cache.version, 2)
+
+    def test_give_up(self):
+        cache = self.prepare({'title': 'fuga', 'bar': ContentFile('bar', name='bar.txt')})
+        with patch.object(CachePostCache, 'set_cache_if', return_value=False) as set_cache_if:
+            self.assertRaises(PostCacheConflict, cache.commit)
+        self.assertEqual(set_cache_if.call_count, 4)
+
+        cache = CachePostCache('key')
+        self.assertEqual(cache.POST['title'], 'hoge')
+        self.assertEqual(list(cache.file_cache.list_files()), [cache.FILES['foo'].name])
@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from ..cache.db import DatabasePostCache
+from ..models import PostCacheEntry
+
+
+class DatabasePostCacheTest(TestCase):
+    def setUp(self):
+        self.cache = DatabasePostCache('key', new=True)
+
+    def test_set_cache(self, *args, **kwargs):
+        self.assertEqual(self.cache.get_cache('key'), None)
+        self.cache.set_cache('key', 'value1')
+        self.assertEqual(self.cache.get_cache('key'), 'value1')
+        self.cache.set_cache('key', 'value2')
+        self.assertEqual(self.cache.get_cache('key'), 'value2')
+        self.assertEqual(PostCacheEntry.objects.count(), 1)
+
+    def test_delete_cache(self, *args, **kwargs):
+        self.cache.set_cache('key', 'value')
+        self.cache.delete_cache('key')
+        self.assertEqual(self.cache.get_cache('key'), None)
+
+    def test_delete_expired(self, *args, **kwargs):
+        self.cache.set_cache('key', 'value')
+        self.cache.set_cache('expired', 'value')
+        PostCacheEntry.objects.filter(key='expired').update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.cache.get_cache('expired'), None)
+
+        DatabasePostCache.delete_expired()
+        self.assertEqual(list(PostCacheEntry.objects.values_list('key', flat=True)), ['key'])
+
+    def test_set_cache_if(self, *args, **kwargs):
+        self.assertTrue(self.cache.set_cache_if('key', 'value1', 0))
+        self.assertFalse(self.cache.set_cache_if('key', 'value2', 0))
+        self.assertTrue(self.cache.set_cache_if('key', 'value2', 1, 'id'))
+        self.assertFalse(self.cache.set_cache_if('key', 'value3', 1, 'id'))
+        self.assertEqual(self.cache.get_cache('key'), 'value2')
+
+        PostCacheEntry.objects.filter(key='key').update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(self.cache.set_cache_if('key', 'value3', 0))
+        self.assertEqual(self.cache.get_cache('key'), 'value3')
+
+    def test_unversioned(self, *args, **kwargs):
+        # Stored before saves were versioned.
+        self.cache.set_cache('key', 'value1')
+        self.assertTrue(self.cache.set_cache_if('key', 'value2', 3, ''))
+        self.assertEqual(PostCacheEntry.objects.get(key='key').version, 4)
+        self.assertFalse(self.cache.set_cache_if('key', 'value3', 3, ''))
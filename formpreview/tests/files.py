@@ -1,8 +1,22 @@
+from io import BytesIO
+import os
+import shutil
+import tempfile
+import time
+from unittest import skipIf
+
 from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.test import TestCase
 from mock import patch
 
-from ..files import CachedFile, FileCache
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from ..files import CachedFile, ChunkedFile, FileCache, HashedFileCache
 
 
 class FileCacheTest(TestCase):
@@ -14,7 +28,7 @@ class FileCacheTest(TestCase):
             'path.return_value': '/document_root/media/path/to/storage/filename',
             'delete.return_value': None,
         })
-        self.patcher.start()
+        self.storage = self.patcher.start()
         self.file_cache = FileCache()
 
     def tearDown(self):
@@ -26,10 +40,196 @@ class FileCacheTest(TestCase):
         path = self.file_cache.save(file_object)
         self.assertTrue(isinstance(path, str))
 
+    def test_save_chunked(self, *args, **kwargs):
+        file_object = ContentFile('xxx')
+        file_object.name = 'filename'
+        with self.settings(FORM_PREVIEW_FILE_CHUNK_SIZE=1):
+            self.file_cache.save(file_object)
+        content = self.storage.save.call_args[0][1]
+        self.assertTrue(isinstance(content, ChunkedFile))
+        self.assertEqual(list(content.chunks()), ['x', 'x', 'x'])
+
     def test_load(self, *args, **kwargs):
         file_object = self.file_cache.load('/path/to/filename')
         self.assertTrue(isinstance(file_object, CachedFile))
+        self.assertEqual(self.storage.open.call_count, 0)
+        self.assertEqual(file_object.url, '/media/path/to/storage/filename')
+        self.assertEqual(self.storage.open.call_count, 0)
+        self.assertEqual(self.storage.path.call_count, 0)
+        list(file_object.chunks())
+        self.storage.open.assert_called_once_with('/path/to/filename')
+
+    def test_load_written_file(self, *args, **kwargs):
+        file_object = self.file_cache.load('/path/to/filename', ContentFile('xxx'))
+        self.assertTrue(isinstance(file_object, CachedFile))
+        self.assertEqual(self.storage.open.call_count, 0)
+        self.assertEqual(file_object.read(), 'xxx')
 
     def test_delete(self, *args, **kwargs):
         path = '/path/to/filename'
         self.assertEqual(self.file_cache.delete(path), None)
+
+    def test_delete_many(self, *args, **kwargs):
+        paths = ['/path/to/filename1', '/path/to/filename2']
+        self.file_cache.delete_many(paths)
+        self.storage.delete_many.assert_called_once_with(paths)
+        self.assertEqual(self.storage.delete.call_count, 0)
+
+
+class FileSystemFileCacheTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.patcher = patch('formpreview.files.FileCache._storage', FileSystemStorage(self.location))
+        self.patcher.start()
+        self.file_cache = FileCache()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+
+    def test_save_links_temporary_file(self, *args, **kwargs):
+        file_object = TemporaryUploadedFile('sample.txt', 'text/plain', 3, None)
+        file_object.write('xxx')
+        file_object.flush()
+
+        path = self.file_cache.save(file_object)
+        full_path = os.path.join(self.location, path)
+        self.assertTrue(os.path.samefile(full_path, file_object.temporary_file_path()))
+        self.assertFalse(file_object.closed)
+        file_object.close()
+        with open(full_path) as f:
+            self.assertEqual(f.read(), 'xxx')
+
+    def test_save_many(self, *args, **kwargs):
+        paths = self.file_cache.save_many([ContentFile(str(i) * 3, name='sample.txt') for i in range(3)])
+        self.assertEqual(len(set(paths)), 3)
+        for i, path in enumerate(paths):
+            with open(os.path.join(self.location, path)) as f:
+                self.assertEqual(f.read(), str(i) * 3)
+
+    def test_delete_many(self, *args, **kwargs):
+        paths = [self.file_cache.save(ContentFile('xxx', name='sample.txt')) for i in range(3)]
+        self.file_cache.delete_many(paths)
+        for path in paths:
+            self.assertFalse(os.path.exists(os.path.join(self.location, path)))
+
+    def test_save_async(self, *args, **kwargs):
+        file_object = TemporaryUploadedFile('sample.txt', 'text/plain', 3, None)
+        file_object.write('xxx')
+        file_object.flush()
+        with self.settings(FORM_PREVIEW_FILE_CACHE_ASYNC=True):
+            path = self.file_cache.save(file_object)
+        file_object.close()
+
+        self.file_cache.wait([path])
+        self.assertFalse(self.file_cache.is_pending(path))
+        with open(os.path.join(self.location, path)) as f:
+            self.assertEqual(f.read(), 'xxx')
+
+    def test_save_async_failure(self, *args, **kwargs):
+        with self.settings(FORM_PREVIEW_FILE_CACHE_ASYNC=True):
+            with patch.object(self.file_cache, 'write_sync', side_effect=IOError('failed')):
+                path = self.file_cache.save(ContentFile('xxx', name='sample.txt'))
+                while self.file_cache.is_pending(path):
+                    time.sleep(0.01)
+        self.assertRaises(IOError, self.file_cache.wait, [path])
+        self.file_cache.wait([path])
+
+    def test_save_streams_file(self, *args, **kwargs):
+        file_object = ContentFile('xxx')
+        file_object.name = 'sample.txt'
+        path = self.file_cache.save(file_object)
+        with open(os.path.join(self.location, path)) as f:
+            self.assertEqual(f.read(), 'xxx')
+
+
+class HashedFileCacheTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(self.location)
+        self.patcher = patch('formpreview.files.FileCache._storage', self.storage)
+        self.patcher.start()
+        self.file_cache = HashedFileCache()
+        self.file_cache._refs.clear()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+
+    def test_deduplicate(self, *args, **kwargs):
+        with patch.object(self.storage, 'save', wraps=self.storage.save) as save:
+            path1 = self.file_cache.save(ContentFile('xxx', name='a.txt'))
+            path2 = self.file_cache.save(ContentFile('xxx', name='b.txt'))
+            path3 = self.file_cache.save(ContentFile('yyy', name='c.txt'))
+        self.assertEqual(path1, path2)
+        self.assertNotEqual(path1, path3)
+        self.assertEqual(save.call_count, 2)
+
+        self.file_cache.delete(path1)
+        self.assertTrue(self.storage.exists(path1))
+        self.file_cache.delete_many([path2, path3])
+        self.assertFalse(self.storage.exists(path1))
+        self.assertFalse(self.storage.exists(path3))
+
+    def test_deduplicate_async(self, *args, **kwargs):
+        # Both requests see no stored or pending file, as if they were in
+        # separate processes.
+        with self.settings(FORM_PREVIEW_FILE_CACHE_ASYNC=True):
+            with patch.object(self.file_cache, 'is_pending', return_value=False):
+                path1 = self.file_cache.save(ContentFile('xxx', name='a.txt'))
+                self.file_cache.wait([path1])
+                with patch.object(self.storage, 'exists', return_value=False):
+                    path2 = self.file_cache.save(ContentFile('xxx', name='b.txt'))
+                self.file_cache.wait([path2])
+        self.assertEqual(path1, path2)
+        self.assertEqual(list(self.file_cache.list_files()), [path1])
+
+
+@skipIf(Image is None, 'Pillow is not installed.')
+class ThumbnailTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(self.location)
+        self.patcher = patch('formpreview.files.FileCache._storage', self.storage)
+        self.patcher.start()
+        self.settings_override = self.settings(FORM_PREVIEW_THUMBNAIL_SIZE=(10, 10))
+        self.settings_override.enable()
+        self.file_cache = FileCache()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+
+    def create_image(self, name='sample.png'):
+        output = BytesIO()
+        Image.new('RGB', (100, 50)).save(output, 'PNG')
+        return ContentFile(output.getvalue(), name=name)
+
+    def test_thumbnail(self):
+        path = self.file_cache.save(self.create_image())
+        thumbnail = self.file_cache.load(path).thumbnail
+        self.assertEqual(thumbnail.name, self.file_cache.get_thumbnail_path(path))
+        self.assertEqual(Image.open(thumbnail).size, (10, 5))
+        thumbnail.close()
+
+        self.file_cache.delete(path)
+        self.assertFalse(self.storage.exists(path))
+        self.assertFalse(self.storage.exists(thumbnail.name))
+
+    def test_async(self):
+        with self.settings(FORM_PREVIEW_THUMBNAIL_ASYNC=True):
+            path = self.file_cache.save(self.create_image())
+        thumbnail_path = self.file_cache.get_thumbnail_path(path)
+        self.file_cache.wait([thumbnail_path])
+        self.assertTrue(self.storage.exists(thumbnail_path))
+
+    def test_not_an_image(self):
+        path = self.file_cache.save(ContentFile('xxx', name='sample.png'))
+        self.assertEqual(self.file_cache.load(path).thumbnail, None)
+        self.assertEqual(self.storage.listdir(os.path.dirname(path))[1], [os.path.basename(path)])
+
+    def test_disabled(self):
+        with self.settings(FORM_PREVIEW_THUMBNAIL_SIZE=None):
+            path = self.file_cache.save(self.create_image())
+            self.assertEqual(self.file_cache.load(path).thumbnail_name, None)
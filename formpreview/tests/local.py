@@ -0,0 +1,65 @@
+from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import patch
+
+from ..cache import CachePostCache
+from ..cache.local import LocalCache, LocalCachePostCache
+
+
+class LocalCacheTest(TestCase):
+    def test_lru(self, *args, **kwargs):
+        cache = LocalCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'entries': 2})
+
+    def test_timeout(self, *args, **kwargs):
+        cache = LocalCache(2, 0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+
+class LocalCachePostCacheTest(TestCase):
+    def setUp(self):
+        LocalCachePostCache._local.clear()
+        LocalCachePostCache._cache.clear()
+        self.cache = LocalCachePostCache('key', new=True)
+
+    def tearDown(self):
+        LocalCachePostCache._cache.clear()
+
+    def test_write_through(self, *args, **kwargs):
+        self.cache.set_cache('key', 'value')
+        with patch.object(LocalCachePostCache._cache, 'get') as get:
+            self.assertEqual(self.cache.get_cache('key'), 'value')
+            self.assertEqual(get.call_count, 0)
+        self.assertEqual(LocalCachePostCache._cache.get('key'), 'value')
+        self.assertEqual(LocalCachePostCache.stats()['hits'], 1)
+
+    def test_miss(self, *args, **kwargs):
+        LocalCachePostCache._cache.set('key', 'value')
+        self.assertEqual(self.cache.get_cache('key'), 'value')
+        self.assertEqual(self.cache.get_cache('key'), 'value')
+        self.assertEqual(LocalCachePostCache.stats()['hits'], 1)
+        self.assertEqual(LocalCachePostCache.stats()['misses'], 1)
+
+    def test_delete(self, *args, **kwargs):
+        self.cache.set_cache('key', 'value')
+        self.cache.delete_cache('key')
+        self.assertEqual(self.cache.get_cache('key'), None)
+
+    def test_post_stage_reads_shared(self, *args, **kwargs):
+        self.cache.save(RequestFactory().post('/', {'title': 'hoge'}))
+        # Another process saves a newer version to the shared cache only.
+        other = CachePostCache('key')
+        other.save(RequestFactory().post('/', {'title': 'fuga'}))
+
+        self.assertEqual(LocalCachePostCache('key').POST['title'], 'hoge')
+        cache = LocalCachePostCache('key')
+        cache.wait_files()
+        self.assertEqual(cache.POST['title'], 'fuga')
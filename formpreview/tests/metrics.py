@@ -0,0 +1,51 @@
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import patch
+
+from ..metrics import MemoryCollector, NullCollector, StatsdCollector
+from .views import SampleView
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        SampleView.post_cache_class._cache.clear()
+        self.collector = MemoryCollector()
+        self.patchers = [
+            patch('formpreview.views.FormPreviewMixin.metrics', self.collector),
+            patch('formpreview.cache.base.PostCacheBase.metrics', self.collector),
+        ]
+        for p in self.patchers:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patchers:
+            p.stop()
+
+    def test_stages(self, *args, **kwargs):
+        view = SampleView.as_view()
+        view(self.factory.post('/', {
+            'stage': 'preview', 'cache_key': 'key', 'title': 'hoge', 'body': 'piyo',
+            'attachment': SimpleUploadedFile('sample.txt', 'xxx'),
+        }))
+        view(self.factory.post('/', {'stage': 'post', 'cache_key': 'key'}))
+
+        snapshot = self.collector.snapshot()
+        self.assertEqual(snapshot['counters']['files.saved'], 1)
+        self.assertEqual(snapshot['counters']['cache.miss'], 1)
+        self.assertEqual(snapshot['counters']['cache.hit'], 1)
+        for name in ('stage.preview.dispatch', 'stage.post.dispatch', 'stage.post.done',
+                     'form.is_valid', 'files.save', 'files.load', 'cache.load', 'cache.save'):
+            self.assertTrue(snapshot['summaries'][name]['count'] >= 1, name)
+        self.assertEqual(snapshot['summaries']['cache.payload_bytes']['count'], 2)
+
+    def test_null_collector(self, *args, **kwargs):
+        collector = NullCollector()
+        self.assertTrue(collector.timer('a') is collector.timer('b'))
+
+    def test_statsd(self, *args, **kwargs):
+        collector = StatsdCollector(host='localhost', port=8125, prefix='test')
+        with patch.object(collector, 'socket') as sock:
+            collector.incr('cache.hit')
+            sock.sendto.assert_called_once_with('test.cache.hit:1|c', ('localhost', 8125))
@@ -0,0 +1,67 @@
+# coding=utf8
+from __future__ import unicode_literals
+
+from django import forms
+from django.test import TestCase
+from django.utils.datastructures import MultiValueDict
+from mock import Mock
+
+from ..files import CachedFile
+from ..preview import FormPreview, get_plan, render_image
+
+
+class PreviewForm(forms.Form):
+    title = forms.CharField(label='Title')
+    color = forms.ChoiceField(label='Color', choices=[('r', 'Red'), ('g', 'Green')])
+    attachment = forms.FileField(label='Attachment')
+    token = forms.CharField(widget=forms.HiddenInput)
+
+
+class FormPreviewTest(TestCase):
+    def setUp(self):
+        storage = Mock(**{'url.return_value': '/media/formpreview/sample.txt'})
+        self.form = PreviewForm(
+            {'title': '<b>hoge</b>', 'color': 'g', 'token': 'x'},
+            MultiValueDict({'attachment': [CachedFile(storage, 'formpreview/sample.txt')]}),
+        )
+        self.assertTrue(self.form.is_valid())
+
+    def test_as_table(self, *args, **kwargs):
+        self.assertEqual(FormPreview(self.form).as_table(), '\n'.join([
+            '<tr><th>Title</th><td>&lt;b&gt;hoge&lt;/b&gt;</td></tr>',
+            '<tr><th>Color</th><td>Green</td></tr>',
+            '<tr><th>Attachment</th><td>'
+            '<a href="/media/formpreview/sample.txt">formpreview/sample.txt</a></td></tr>',
+        ]))
+
+    def test_as_ul(self, *args, **kwargs):
+        html = FormPreview(self.form).as_ul()
+        self.assertTrue(html.startswith('<li>Title: &lt;b&gt;hoge&lt;/b&gt;</li>\n<li>Color: Green</li>'))
+
+    def test_as_p(self, *args, **kwargs):
+        html = FormPreview(self.form).as_p()
+        self.assertTrue(html.startswith('<p>Title: &lt;b&gt;hoge&lt;/b&gt;</p>'))
+
+    def test_plan(self, *args, **kwargs):
+        plan = get_plan(self.form)
+        self.assertTrue(get_plan(PreviewForm()) is plan)
+        self.assertEqual([name for name, renderer in plan.rows], ['title', 'color', 'attachment'])
+
+        del self.form.fields['color']
+        self.assertEqual([name for name, renderer in get_plan(self.form).rows], ['title', 'attachment'])
+
+        self.form.fields['title'].widget = forms.HiddenInput()
+        self.assertEqual([name for name, renderer in get_plan(self.form).rows], ['attachment'])
+        self.assertTrue(get_plan(PreviewForm()) is plan)
+
+    def test_thumbnail(self, *args, **kwargs):
+        storage = Mock(**{
+            'url.side_effect': lambda name: '/media/' + name,
+            'exists.return_value': True,
+        })
+        image = CachedFile(storage, 'formpreview/sample.png', thumbnail_name='formpreview/sample.thumb.png')
+        self.assertEqual(
+            render_image(forms.ImageField(), image),
+            '<a href="/media/formpreview/sample.png">'
+            '<img src="/media/formpreview/sample.thumb.png" alt="formpreview/sample.png"></a>'
+        )
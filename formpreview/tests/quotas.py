@@ -0,0 +1,79 @@
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils.datastructures import MultiValueDict
+from mock import patch
+
+from ..files import FileCache
+from ..quotas import Quota, QuotaExceeded
+from views import SampleView
+
+
+class QuotaTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.patcher = patch('formpreview.files.FileCache._storage', FileSystemStorage(self.location))
+        self.patcher.start()
+        self.file_cache = FileCache()
+        SampleView.post_cache_class._cache.clear()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+        SampleView.post_cache_class._cache.clear()
+
+    def list_files(self):
+        return list(self.file_cache.list_files())
+
+    def test_check_files(self):
+        files = MultiValueDict({'a': [ContentFile('xxx', name='a.txt')] * 2})
+        self.assertRaises(QuotaExceeded, Quota(max_files=1).check_files, files)
+        with self.assertRaises(QuotaExceeded) as cm:
+            Quota(max_field_files=1).check_files(files)
+        self.assertEqual(cm.exception.field, 'a')
+        self.assertRaises(QuotaExceeded, Quota(max_size=5).check_files, files)
+        Quota(max_files=2, max_size=6).check_files(files)
+
+    def test_abort_stream(self):
+        file_object = ContentFile('x' * 10, name='sample.txt')
+        quota = Quota(max_field_size=4)
+        with self.settings(FORM_PREVIEW_FILE_CHUNK_SIZE=2):
+            with patch.object(ContentFile, 'read', wraps=file_object.read) as read:
+                self.assertRaises(QuotaExceeded, self.file_cache.save, file_object, quota)
+        self.assertEqual(read.call_count, 3)
+        self.assertEqual(self.list_files(), [])
+
+    def test_save_many_cleans_up(self):
+        file_objects = [ContentFile(str(i) * 3, name='sample.txt') for i in range(3)]
+        quota = Quota(max_size=7)
+        self.assertRaises(QuotaExceeded, self.file_cache.save_many, file_objects, quota)
+        self.assertEqual(self.list_files(), [])
+
+    def test_view(self):
+        request = RequestFactory().post('/', {
+            'stage': 'preview', 'cache_key': 'key', 'title': 'hoge', 'body': 'piyopiyo',
+            'attachment': ContentFile('xxx', name='sample.txt'),
+        })
+        view = SampleView(request=request, args=(), kwargs={})
+        with self.settings(FORM_PREVIEW_MAX_FIELD_SIZE=2):
+            response = view.dispatch(request)
+        form = response.context_data['form']
+        self.assertEqual(view.stage, 'input')
+        self.assertEqual(form['title'].value(), 'hoge')
+        self.assertTrue(form.errors['attachment'])
+        self.assertEqual(self.list_files(), [])
+        self.assertEqual(SampleView.post_cache_class('key').POST, {})
+
+    def test_data_size(self):
+        request = RequestFactory().post('/', {
+            'stage': 'preview', 'cache_key': 'key', 'title': 'hoge', 'body': 'x' * 100,
+        })
+        view = SampleView(request=request, args=(), kwargs={})
+        with self.settings(FORM_PREVIEW_MAX_DATA_SIZE=50):
+            response = view.dispatch(request)
+        self.assertEqual(view.stage, 'input')
+        self.assertTrue(response.context_data['form'].non_field_errors())
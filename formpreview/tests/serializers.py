@@ -0,0 +1,42 @@
+# coding=utf8
+from __future__ import unicode_literals
+
+from django.http.request import QueryDict
+from django.test import TestCase
+from django.utils.datastructures import MultiValueDict
+
+from ..cache.serializers import CompactSerializer
+
+
+class CompactSerializerTest(TestCase):
+    def setUp(self):
+        self.serializer = CompactSerializer(compress_threshold=200)
+
+    def create_payload(self, body):
+        data = QueryDict('', mutable=True)
+        data.setlist('title', ['ほげ'])
+        data.setlist('tags', ['a', 'b'])
+        data['body'] = body
+        files = MultiValueDict({'attachment': ['formpreview/filename.txt']})
+        return {'data': data, 'files': files}
+
+    def test_round_trip(self, *args, **kwargs):
+        value = self.serializer.dumps(self.create_payload('piyo'))
+        self.assertEqual(value[:1], CompactSerializer.PLAIN)
+
+        payload = self.serializer.loads(value)
+        self.assertTrue(isinstance(payload['data'], QueryDict))
+        self.assertEqual(payload['data']['title'], 'ほげ')
+        self.assertEqual(payload['data'].getlist('tags'), ['a', 'b'])
+        self.assertEqual(payload['files'].getlist('attachment'), ['formpreview/filename.txt'])
+
+    def test_compress(self, *args, **kwargs):
+        body = 'piyo' * 1000
+        value = self.serializer.dumps(self.create_payload(body))
+        self.assertEqual(value[:1], CompactSerializer.COMPRESSED)
+        self.assertTrue(len(value) < len(body))
+        self.assertEqual(self.serializer.loads(value)['data']['body'], body)
+
+    def test_load_dict(self, *args, **kwargs):
+        payload = self.create_payload('piyo')
+        self.assertEqual(self.serializer.loads(payload), payload)
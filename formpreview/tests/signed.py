@@ -0,0 +1,63 @@
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from ..cache.signed import SignedPostCache
+from views import SampleView
+
+
+class SignedView(SampleView):
+    post_cache_class = SignedPostCache
+    done_count = 0
+
+    def done(self, form):
+        SignedView.done_count += 1
+        return super(SignedView, self).done(form)
+
+
+class SignedPostCacheTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def save(self, data):
+        cache = SignedPostCache('key', new=True)
+        cache.save(self.factory.post('/', data))
+        return cache.key
+
+    def test_signed(self, *args, **kwargs):
+        key = self.save({'title': 'hoge'})
+        self.assertTrue(key.startswith(SignedPostCache.prefix))
+        self.assertEqual(SignedPostCache(key).POST['title'], 'hoge')
+
+    def test_tampered(self, *args, **kwargs):
+        key = self.save({'title': 'hoge'})
+        self.assertEqual(len(SignedPostCache(key + 'x').POST), 0)
+
+    def test_fallback(self, *args, **kwargs):
+        body = ''.join('%08d' % i for i in range(1000))
+        with self.settings(FORM_PREVIEW_SIGNED_MAX_SIZE=100):
+            key = self.save({'title': 'hoge', 'body': body})
+            self.assertFalse(key.startswith(SignedPostCache.prefix))
+            self.assertEqual(SignedPostCache(key).POST['body'], body)
+
+    def test_cleared(self, *args, **kwargs):
+        key = self.save({'title': 'hoge'})
+        SignedPostCache(key).clear()
+        self.assertEqual(len(SignedPostCache(key).POST), 0)
+
+    def request(self, data):
+        request = self.factory.post('/', data)
+        view = SignedView(request=request, args=(), kwargs={})
+        return view, view.dispatch(request)
+
+    def test_replay(self, *args, **kwargs):
+        SignedView.done_count = 0
+        view, response = self.request({'stage': 'preview', 'title': 'hoge', 'body': 'piyopiyo'})
+        self.assertEqual(view.stage, 'preview')
+        cache_key = view.cache_key
+
+        view, response = self.request({'stage': 'post', 'cache_key': cache_key})
+        self.assertEqual(response.status_code, 302)
+        view, response = self.request({'stage': 'post', 'cache_key': cache_key})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(view.stage, 'input')
+        self.assertEqual(SignedView.done_count, 1)
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+from mock import patch
+
+from ..cache.registry import FileRegistry
+from ..files import FileCache
+from ..sweeper import sweep
+
+
+class SweeperTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(self.location)
+        self.patcher = patch('formpreview.files.FileCache._storage', self.storage)
+        self.patcher.start()
+        self.file_cache = FileCache()
+        self.file_registry = FileRegistry()
+        self.file_registry._cache.clear()
+
+        self.owned = self.save_file(age=48 * 60 * 60)
+        self.orphaned = self.save_file(age=48 * 60 * 60)
+        self.recent = self.save_file(age=0)
+        self.file_registry.register('key', [self.owned], 60)
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+
+    def save_file(self, age):
+        path = self.file_cache.save(ContentFile('xxx', name='sample.txt'))
+        mtime = time.time() - age
+        os.utime(self.storage.path(path), (mtime, mtime))
+        return path
+
+    def sweep(self, **kwargs):
+        return sweep(file_cache=self.file_cache, file_registry=self.file_registry, **kwargs)
+
+    def test_dry_run(self, *args, **kwargs):
+        report = self.sweep(dry_run=True)
+        self.assertEqual([path for path, modified in report], [self.orphaned])
+        self.assertTrue(self.storage.exists(self.orphaned))
+
+    def test_sweep(self, *args, **kwargs):
+        report = self.sweep(batch_size=1)
+        self.assertEqual([path for path, modified in report], [self.orphaned])
+        self.assertFalse(self.storage.exists(self.orphaned))
+        self.assertTrue(self.storage.exists(self.owned))
+        self.assertTrue(self.storage.exists(self.recent))
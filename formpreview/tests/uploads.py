@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import patch
+
+from ..cache.base import PostCacheBase
+from ..uploads import ChunkedUploadView
+from views import SampleView
+
+
+class ChunkedUploadTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.spool_dir = tempfile.mkdtemp()
+        self.patcher = patch('formpreview.files.FileCache._storage', FileSystemStorage(self.location))
+        self.patcher.start()
+        self.settings_override = self.settings(FORM_PREVIEW_UPLOAD_SPOOL_DIR=self.spool_dir)
+        self.settings_override.enable()
+        self.factory = RequestFactory()
+        self.view = ChunkedUploadView.as_view()
+        SampleView.post_cache_class._cache.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+        shutil.rmtree(self.spool_dir)
+        SampleView.post_cache_class._cache.clear()
+
+    def send(self, content, offset, **data):
+        data.update(cache_key='key', offset=offset, chunk=ContentFile(content, name='blob'))
+        response = self.view(self.factory.post('/', data))
+        return response.status_code, json.loads(response.content)
+
+    def upload(self):
+        status, result = self.send('xx', 0, name='sample.txt', size=4, field='attachment')
+        self.assertEqual(status, 200)
+        self.assertEqual(result['offset'], 2)
+        self.assertFalse(result['complete'])
+        upload_id = result['upload_id']
+
+        status, result = self.send('yy', 4, upload_id=upload_id)
+        self.assertEqual(status, 409)
+        self.assertEqual(result['offset'], 2)
+
+        response = self.view(self.factory.get('/', {'cache_key': 'key', 'upload_id': upload_id}))
+        self.assertEqual(json.loads(response.content)['offset'], 2)
+        response = self.view(self.factory.get('/', {'cache_key': 'other', 'upload_id': upload_id}))
+        self.assertEqual(response.status_code, 404)
+
+        status, result = self.send('yy', 2, upload_id=upload_id)
+        self.assertEqual(status, 200)
+        self.assertTrue(result['complete'])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        return upload_id
+
+    def submit(self, upload_id):
+        request = self.factory.post('/', {
+            'stage': 'preview', 'cache_key': 'key', 'title': 'hoge', 'body': 'piyopiyo',
+            'attachment__upload': upload_id,
+        })
+        view = SampleView(request=request, args=(), kwargs={})
+        return view, view.dispatch(request)
+
+    def test_upload(self):
+        upload_id = self.upload()
+        view, response = self.submit(upload_id)
+        self.assertEqual(view.stage, 'preview')
+        attachment = response.context_data['form'].cleaned_data['attachment']
+        self.assertEqual(attachment.read(), 'xxyy')
+        self.assertEqual(PostCacheBase.upload_registry.get('key', upload_id), None)
+        self.assertEqual(SampleView.post_cache_class('key').FILES['attachment'].name, attachment.name)
+
+    def test_oversized(self):
+        with self.settings(FORM_PREVIEW_MAX_FIELD_SIZE=3):
+            status, result = self.send('xx', 0, name='sample.txt', size=4, field='attachment')
+        self.assertEqual(status, 413)
+        status, result = self.send('xxx', 0, name='sample.txt', size=2)
+        self.assertEqual(status, 400)
+
+    def test_unclaimed_quota(self):
+        with self.settings(FORM_PREVIEW_MAX_FILES=2, FORM_PREVIEW_MAX_UPLOAD_SIZE=6):
+            upload_id = self.upload()
+            self.assertEqual(self.send('xxx', 0, name='b.txt', size=3)[0], 413)
+            self.assertEqual(self.send('xx', 0, name='b.txt', size=2)[0], 200)
+            self.assertEqual(self.send('x', 0, name='c.txt', size=1)[0], 413)
+
+            # A submission picks up the first upload and its share of the quota.
+            view, response = self.submit(upload_id)
+            self.assertEqual(view.stage, 'preview')
+            self.assertEqual(self.send('x', 0, name='c.txt', size=1)[0], 200)
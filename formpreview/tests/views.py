@@ -1,15 +1,22 @@
+import shutil
 import StringIO
+import tempfile
+import time
 
 from django import forms
+from django.forms import models as model_forms
 from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.test import TestCase
 from django.test.client import RequestFactory
 from django.utils.datastructures import MultiValueDict
-from mock import patch
+from mock import Mock, patch
 
-from ..views import FormView
-from ..files import CachedFile
+from ..files import CachedFile, FileCache
+from ..models import PostCacheEntry
+from ..views import CreateView, FormView
 
 
 class SampleForm(forms.Form):
@@ -32,8 +39,7 @@ class FormViewTest(TestCase):
 
         io = StringIO.StringIO('xxx')
         self.file_object = InMemoryUploadedFile(io, None, 'sample.txt', 'text', io.len, None)
-        self.test_file = CachedFile(self.file_object, '/path/to/filename', '/path/to/filename')
-        self.test_file.name = 'sample.txt'
+        self.test_file = CachedFile(Mock(), 'sample.txt', self.file_object)
 
         self.patcher = patch('formpreview.views.FormView.post_cache_class', ** {
             'return_value.save.return_value': None,
@@ -99,3 +105,140 @@ class FormViewTest(TestCase):
         response = self.view(request)
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response['Location'], SampleView.success_url)
+
+    def test_deferred_cleanup(self):
+        request = self.factory.post('/', {'stage': 'post', 'cache_key': 'key'})
+        self.add_session_to_request(request)
+        response = SampleView.as_view(defer_cleanup=True)(request)
+        self.assertEqual(response.status_code, 302)
+
+        post_cache = SampleView.post_cache_class.return_value
+        post_cache.clear.assert_called_once_with(defer=True)
+        self.assertEqual(post_cache.close.call_count, 0)
+        response.close()
+        post_cache.close.assert_called_once_with()
+
+
+class CountingForm(SampleForm):
+    clean_count = 0
+
+    def clean_title(self):
+        CountingForm.clean_count += 1
+        return self.cleaned_data['title'].upper()
+
+
+class CleanedDataView(SampleView):
+    form_class = CountingForm
+    cache_cleaned_data = True
+
+    def done(self, form):
+        self.cleaned_data = form.cleaned_data
+        return super(CleanedDataView, self).done(form)
+
+
+class CleanedDataTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        CleanedDataView.post_cache_class._cache.clear()
+        CountingForm.clean_count = 0
+
+    def request(self, data):
+        request = self.factory.post('/', data)
+        view = CleanedDataView(request=request, args=(), kwargs={})
+        response = view.dispatch(request)
+        return view, response
+
+    def preview(self):
+        view, response = self.request({
+            'stage': 'preview', 'cache_key': 'key', 'title': 'hoge', 'body': 'piyopiyo',
+        })
+        self.assertEqual(view.stage, 'preview')
+        return view.cache_key
+
+    def test_skip_validation(self):
+        cache_key = self.preview()
+        self.assertEqual(CountingForm.clean_count, 1)
+
+        view, response = self.request({'stage': 'post', 'cache_key': cache_key})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(CountingForm.clean_count, 1)
+        self.assertEqual(view.cleaned_data['title'], 'HOGE')
+        self.assertEqual(view.cleaned_data['attachment'], None)
+
+    def test_unchanged_preview(self):
+        with self.settings(FORM_PREVIEW_INCREMENTAL_SAVE=True):
+            cache_key = self.preview()
+            # Signed tokens carry a timestamp.
+            with patch('django.core.signing.time.time', return_value=time.time() + 10):
+                self.preview()
+        post_cache = CleanedDataView.post_cache_class(cache_key)
+        post_cache.load()
+        self.assertEqual(post_cache.version, 1)
+        self.assertTrue(post_cache.extra['cleaned_data'])
+
+    def test_changed_data(self):
+        cache_key = self.preview()
+        # Change the cached data but keep the token cleaned from the old data.
+        post_cache = CleanedDataView.post_cache_class(cache_key)
+        post_cache.prepare(self.factory.post('/', {'title': 'fuga', 'body': 'piyopiyo'}))
+        post_cache.commit(cleaned_data=post_cache.extra['cleaned_data'])
+
+        view, response = self.request({'stage': 'post', 'cache_key': cache_key})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(CountingForm.clean_count, 2)
+        self.assertEqual(view.cleaned_data['title'], 'FUGA')
+
+
+class ValidateFirstTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.patcher = patch('formpreview.files.FileCache._storage', FileSystemStorage(self.location))
+        self.patcher.start()
+        SampleView.post_cache_class._cache.clear()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.location)
+        SampleView.post_cache_class._cache.clear()
+
+    def preview(self, data):
+        data = dict(data, stage='preview', cache_key='key', attachment=ContentFile('xxx', name='sample.txt'))
+        request = RequestFactory().post('/', data)
+        view = SampleView(request=request, args=(), kwargs={})
+        return view, view.dispatch(request)
+
+    def test_invalid(self):
+        view, response = self.preview({'body': 'piyopiyo'})
+        self.assertEqual(view.stage, 'input')
+        self.assertTrue(response.context_data['form'].errors['title'])
+        self.assertEqual(list(FileCache().list_files()), [])
+        self.assertEqual(SampleView.post_cache_class._cache.get('key'), None)
+
+    def test_valid(self):
+        view, response = self.preview({'title': 'hoge', 'body': 'piyopiyo'})
+        self.assertEqual(view.stage, 'preview')
+        attachment = response.context_data['form'].cleaned_data['attachment']
+        self.assertTrue(isinstance(attachment, CachedFile))
+        self.assertEqual(list(FileCache().list_files()), [attachment.name])
+        self.assertEqual(SampleView.post_cache_class('key').POST['title'], 'hoge')
+
+
+class FormClassTest(TestCase):
+    def test_cached_form_class(self):
+        class EntryView(CreateView):
+            model = PostCacheEntry
+            fields = ['key']
+
+        class OtherEntryView(CreateView):
+            model = PostCacheEntry
+            fields = ['key', 'expires_at']
+
+        with patch('django.forms.models.modelform_factory', wraps=model_forms.modelform_factory) as factory:
+            form_class = EntryView.prepare_form_class()
+            self.assertEqual(list(form_class.base_fields), ['key'])
+            self.assertTrue(EntryView.prepare_form_class() is form_class)
+            self.assertEqual(factory.call_count, 1)
+
+            other_form_class = OtherEntryView.prepare_form_class()
+            self.assertFalse(other_form_class is form_class)
+            self.assertEqual(factory.call_count, 2)
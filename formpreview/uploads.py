@@ -0,0 +1,91 @@
+import json
+
+from django.http import HttpResponse
+from django.views.generic.base import View
+
+from .cache.base import PostCacheBase
+from .cache.uploads import UploadConflict
+from .quotas import Quota, QuotaExceeded
+from .views import CACHE_KEY_FIELD
+
+
+class ChunkedUploadView(View):
+    """
+    Receives preview files in chunks, so an interrupted upload can be
+    resumed by sending only the missing chunks.
+
+    The first chunk starts an upload with ``name``, ``size`` and,
+    optionally, ``field``; later chunks send the ``upload_id`` from the
+    response. Each chunk is posted as the ``chunk`` file along with its
+    ``offset`` and the form's ``cache_key``. A GET with ``upload_id``
+    returns the offset to resume from. Once complete, the form refers to
+    the upload with a ``<field>__upload`` value of its id. Uploads that no
+    submission has picked up yet share the quota of one submission.
+    """
+    cache_key_field = CACHE_KEY_FIELD
+    http_method_names = ['get', 'post']
+
+    def get_upload_registry(self):
+        return PostCacheBase.upload_registry
+
+    def get_file_cache(self):
+        return PostCacheBase.file_cache
+
+    def get_quota(self):
+        return Quota()
+
+    def render_json(self, data, status=200):
+        return HttpResponse(json.dumps(data), content_type='application/json', status=status)
+
+    def render_upload(self, upload, status=200):
+        return self.render_json({
+            'upload_id': upload['id'],
+            'offset': upload['offset'],
+            'complete': upload['path'] is not None,
+        }, status)
+
+    def get(self, request, *args, **kwargs):
+        upload = self.get_upload_registry().get(
+            request.GET.get(self.cache_key_field, ''), request.GET.get('upload_id', '')
+        )
+        if upload is None:
+            return self.render_json({'error': 'Unknown upload.'}, 404)
+        return self.render_upload(upload)
+
+    def post(self, request, *args, **kwargs):
+        cache_key = request.POST.get(self.cache_key_field)
+        chunk = request.FILES.get('chunk')
+        try:
+            offset = int(request.POST.get('offset', 0))
+        except ValueError:
+            offset = -1
+        if not cache_key or chunk is None or offset < 0:
+            return self.render_json({'error': 'A cache key, an offset and a chunk are required.'}, 400)
+
+        registry = self.get_upload_registry()
+        upload_id = request.POST.get('upload_id')
+        if upload_id:
+            upload = registry.get(cache_key, upload_id)
+            if upload is None:
+                return self.render_json({'error': 'Unknown upload.'}, 404)
+        else:
+            try:
+                size = int(request.POST.get('size', ''))
+            except ValueError:
+                size = -1
+            name = request.POST.get('name') or chunk.name
+            field = request.POST.get('field') or None
+            if size < 0 or offset != 0:
+                return self.render_json({'error': 'The first chunk must give the size of the upload.'}, 400)
+            try:
+                upload = registry.start(cache_key, name, size, field, self.get_quota())
+            except QuotaExceeded as e:
+                return self.render_json({'error': e.message}, 413)
+
+        try:
+            upload = registry.append(cache_key, upload, offset, chunk, self.get_file_cache())
+        except UploadConflict as e:
+            return self.render_json({'error': str(e), 'upload_id': upload['id'], 'offset': e.offset}, 409)
+        except ValueError as e:
+            return self.render_json({'error': str(e)}, 400)
+        return self.render_upload(upload)
@@ -1,20 +1,31 @@
 # coding=utf8
 from __future__ import unicode_literals
 
-from types import MethodType
+import base64
+import hashlib
+import json
 import uuid
 import warnings
 
 from django import forms
-from django.core.exceptions import ImproperlyConfigured
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.forms import models as model_forms
+from django.forms.forms import NON_FIELD_ERRORS
+from django.forms.util import ErrorDict
 from django.http import HttpResponseRedirect
 from django.views.generic.base import TemplateResponseMixin, View
 from django.views.generic.detail import SingleObjectMixin, SingleObjectTemplateResponseMixin
 from django.views.generic.edit import FormMixin
+from django.utils import six
 from django.utils.safestring import mark_safe
+from django.utils.six.moves import cPickle as pickle
 
-from cache import get_post_cache_class
+from backends import LazyBackend
+from cache import PostCacheConflict, get_post_cache_class
+from metrics import get_collector
+from preview import FormPreview
+from quotas import QuotaExceeded
 
 
 STAGE_INPUT = 'input'
@@ -29,35 +40,41 @@ STAGES = {
 STAGE_FIELD = 'stage'
 CACHE_KEY_FIELD = 'cache_key'
 
-
-def _contribute_to_form(form):
-    def preview_as_table(self):
-        rows = []
-        template = '<tr><th>{0}</th><td>{1}</td></tr>'
-        for field in self:
-            if isinstance(field, forms.FileField):
-                rows.append(template.format(field.label, field.data))
-            else:
-                rows.append(template.format(field.label_tag(), field.value()))
-        return mark_safe('\n'.join(rows))
-    form.preview_as_table = MethodType(preview_as_table, form, form.__class__)
+# Generated ModelForm classes keyed by (model, fields, form base).
+_model_form_classes = {}
 
 
 class FormPreviewMixin(FormMixin):
-    post_cache_class = get_post_cache_class()
+    post_cache_class = LazyBackend(get_post_cache_class, 'FORMPREVIEW_CACHE_BACKEND')
     stage_field = STAGE_FIELD
     cache_key_field = CACHE_KEY_FIELD
     input_template = None
     preview_template = None
+    defer_cleanup = False
+    cache_cleaned_data = False
+    conflict_message = 'This form was changed by another request. Please submit it again.'
+    preview_class = FormPreview
+    metrics = LazyBackend(get_collector, 'FORM_PREVIEW_METRICS_COLLECTOR')
 
     def dispatch(self, request, *args, **kwargs):
         self.stage = request.POST.get(self.stage_field, STAGE_INPUT)
         self.stage = self.stage if self.stage in STAGES else STAGE_INPUT
 
         self.cache_key = self.get_cache_key()
-        self.post_cache = self.post_cache_class(self.cache_key)
+        is_new_key = self.cache_key != request.POST.get(self.cache_key_field)
+        self.post_cache = self.get_post_cache_class()(self.cache_key, new=is_new_key)
 
-        return super(FormPreviewMixin, self).dispatch(request, *args, **kwargs)
+        with self.metrics.timer('stage.%s.dispatch' % self.stage):
+            return super(FormPreviewMixin, self).dispatch(request, *args, **kwargs)
+
+    def get_post_cache_class(self):
+        """
+        Returns the post cache class, which may be set as a class or as an
+        import path.
+        """
+        if isinstance(self.post_cache_class, six.string_types):
+            return get_post_cache_class(self.post_cache_class)
+        return self.post_cache_class
 
     def get_cache_key(self):
         return self.request.POST.get(self.cache_key_field, uuid.uuid4().hex)
@@ -86,10 +103,17 @@ class FormPreviewMixin(FormMixin):
         if self.stage == STAGE_INPUT:
             return self.input(form)
         if self.stage == STAGE_PREVIEW:
-            _contribute_to_form(form)
+            try:
+                self.commit(form)
+            except QuotaExceeded as e:
+                return self.quota_exceeded(e)
+            except PostCacheConflict as e:
+                return self.conflict(e)
+            self.contribute_preview(form)
             return self.preview(form)
         if self.stage == STAGE_POST:
-            return self.done(form)
+            with self.metrics.timer('stage.post.done'):
+                return self.done(form)
         else:
             raise ValueError()
 
@@ -97,6 +121,128 @@ class FormPreviewMixin(FormMixin):
         self.stage = STAGE_INPUT
         return self.input(form)
 
+    def commit(self, form):
+        """
+        Writes the validated submission to the cache, along with its
+        cleaned data when ``cache_cleaned_data`` is set.
+        """
+        extra = {}
+        if self.cache_cleaned_data:
+            # The fingerprint covers the paths the files are saved at.
+            self.post_cache.commit_files()
+            token = self.get_cleaned_data_token(form)
+            if token is not None:
+                extra['cleaned_data'] = token
+        self.post_cache.commit(**extra)
+        # Backends may hand out a new key when saving.
+        self.cache_key = self.post_cache.key
+
+        # Refer to the cached files rather than the uploads from now on.
+        cached_files = self.post_cache.FILES
+        for name, field in form.fields.items():
+            key = form.add_prefix(name)
+            if isinstance(field, forms.FileField) and form.cleaned_data.get(name) is form.files.get(key):
+                form.cleaned_data[name] = cached_files.get(key)
+        form.files = cached_files
+
+    def quota_exceeded(self, error):
+        """
+        Shows the input stage again with the error when the submission
+        exceeds the quota. Nothing of it has been cached.
+        """
+        self.metrics.incr('quota.exceeded')
+        return self.reject(error.message, error.field)
+
+    def conflict(self, error):
+        """
+        Shows the input stage again when the submission could not be
+        cached because other requests kept changing the same preview.
+        """
+        return self.reject(self.conflict_message)
+
+    def reject(self, message, field=None):
+        form_class = self.get_form_class()
+        kwargs = self.get_form_kwargs()
+        kwargs['data'] = self.request.POST
+        form = form_class(**kwargs)
+        field = field if field in form.fields else NON_FIELD_ERRORS
+        form.errors.setdefault(field, form.error_class()).append(message)
+        form.cleaned_data.pop(field, None)
+        return self.form_invalid(form)
+
+    def contribute_preview(self, form):
+        preview = self.preview_class(form)
+        form.preview_as_table = preview.as_table
+        form.preview_as_ul = preview.as_ul
+        form.preview_as_p = preview.as_p
+
+    def get_cleaned_data_salt(self, form):
+        return 'formpreview.cleaned_data:%s.%s' % (form.__class__.__module__, form.__class__.__name__)
+
+    def get_fingerprint(self):
+        """
+        Returns a digest of the cached data the form is validated against.
+        """
+        data = sorted(self.post_cache.POST.lists())
+        files = sorted((k, [f.name for f in v]) for k, v in self.post_cache.FILES.lists())
+        return hashlib.sha1(json.dumps([data, files])).hexdigest()
+
+    def get_cleaned_data_token(self, form):
+        """
+        Returns the cleaned data of a valid form with a fingerprint of the
+        data it was cleaned from, signed so it can't be forged. The cached
+        token is reused while the data is the same, so an unchanged
+        preview stays unchanged.
+        """
+        fingerprint = self.get_fingerprint()
+        stored = self.load_cleaned_data_token(form)
+        if stored is not None and stored['fingerprint'] == fingerprint:
+            return self.post_cache.extra['cleaned_data']
+        cleaned_data = dict(
+            (name, value) for name, value in form.cleaned_data.items()
+            if not isinstance(form.fields.get(name), forms.FileField)
+        )
+        try:
+            pickled = pickle.dumps(cleaned_data, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return None
+        return signing.dumps({
+            'fingerprint': fingerprint,
+            'cleaned_data': base64.b64encode(pickled),
+        }, salt=self.get_cleaned_data_salt(form))
+
+    def load_cleaned_data_token(self, form):
+        token = self.post_cache.extra.get('cleaned_data')
+        if not token:
+            return None
+        try:
+            return signing.loads(token, salt=self.get_cleaned_data_salt(form))
+        except signing.BadSignature:
+            return None
+
+    def restore_cleaned_data(self, form):
+        """
+        Fills in the cleaned data stored at the preview stage instead of
+        validating the form again. Returns False when there is nothing valid
+        to restore, in which case the form has to be validated as usual.
+        """
+        stored = self.load_cleaned_data_token(form)
+        if stored is None or stored['fingerprint'] != self.get_fingerprint():
+            return False
+
+        cleaned_data = pickle.loads(base64.b64decode(stored['cleaned_data']))
+        for name, field in form.fields.items():
+            if isinstance(field, forms.FileField):
+                value = field.widget.value_from_datadict(form.data, form.files, form.add_prefix(name))
+                initial = form.initial.get(name, field.initial)
+                try:
+                    cleaned_data[name] = field.clean(value, initial)
+                except ValidationError:
+                    return False
+        form.cleaned_data = cleaned_data
+        form._errors = ErrorDict()
+        return True
+
     def input(self, form):
         self.template_name = self.input_template
         return self.render_to_response(self.get_context_data(form=form))
@@ -106,8 +252,19 @@ class FormPreviewMixin(FormMixin):
         return self.render_to_response(self.get_context_data(form=form))
 
     def done(self, form):
-        self.post_cache.clear()
-        return HttpResponseRedirect(self.get_success_url())
+        self.post_cache.clear(defer=self.defer_cleanup)
+        response = HttpResponseRedirect(self.get_success_url())
+        if self.defer_cleanup:
+            # The handler closes the response once it has been sent.
+            close_response = response.close
+
+            def close():
+                try:
+                    close_response()
+                finally:
+                    self.post_cache.close()
+            response.close = close
+        return response
 
 
 class ModelFormPreviewMixin(FormPreviewMixin, SingleObjectMixin):
@@ -115,6 +272,16 @@ class ModelFormPreviewMixin(FormPreviewMixin, SingleObjectMixin):
     A mixin that provides a way to show and handle a modelform in a request.
     """
     fields = None
+    form_base = model_forms.ModelForm
+
+    @classmethod
+    def prepare_form_class(cls):
+        """
+        Builds the form class ahead of the first request, e.g. from urls.py.
+        """
+        view = cls()
+        view.object = None
+        return view.get_form_class()
 
     def get_form_class(self):
         """
@@ -135,12 +302,19 @@ class ModelFormPreviewMixin(FormPreviewMixin, SingleObjectMixin):
                 # from that
                 model = self.get_queryset().model
 
-            if self.fields is None:
-                warnings.warn("Using ModelFormPreviewMixin (base class of %s) without "
-                              "the 'fields' attribute is deprecated." % self.__class__.__name__,
-                              PendingDeprecationWarning)
-
-            return model_forms.modelform_factory(model, fields=self.fields)
+            fields = self.fields
+            if fields is not None and not isinstance(fields, six.string_types):
+                fields = tuple(fields)
+            key = (model, fields, self.form_base)
+            form_class = _model_form_classes.get(key)
+            if form_class is None:
+                if fields is None:
+                    warnings.warn("Using ModelFormPreviewMixin (base class of %s) without "
+                                  "the 'fields' attribute is deprecated." % self.__class__.__name__,
+                                  PendingDeprecationWarning)
+                form_class = model_forms.modelform_factory(model, form=self.form_base, fields=fields)
+                form_class = _model_form_classes.setdefault(key, form_class)
+            return form_class
 
     def get_form_kwargs(self):
         """
@@ -165,6 +339,13 @@ class ModelFormPreviewMixin(FormPreviewMixin, SingleObjectMixin):
                     " a get_absolute_url method on the Model.")
         return url
 
+    def restore_cleaned_data(self, form):
+        if not super(ModelFormPreviewMixin, self).restore_cleaned_data(form):
+            return False
+        opts = form._meta
+        form.instance = model_forms.construct_instance(form, form.instance, opts.fields, opts.exclude)
+        return True
+
     def done(self, form):
         self.object = form.save()
         return super(ModelFormPreviewMixin, self).done(form)
@@ -178,12 +359,23 @@ class ProcessFormView(View):
 
     def post(self, request, *args, **kwargs):
         if self.stage == STAGE_PREVIEW:
-            self.post_cache.save(request)
+            # Nothing is written until the form turns out to be valid.
+            try:
+                self.post_cache.prepare(request)
+            except QuotaExceeded as e:
+                return self.quota_exceeded(e)
+        if self.stage == STAGE_POST:
+            self.post_cache.wait_files()
         form_class = self.get_form_class()
         form = self.get_form(form_class)
-        if form.is_valid():
+        if self.stage == STAGE_POST and self.cache_cleaned_data and self.restore_cleaned_data(form):
+            return self.form_valid(form)
+        with self.metrics.timer('form.is_valid'):
+            is_valid = form.is_valid()
+        if is_valid:
             return self.form_valid(form)
         else:
+            self.metrics.incr('form.invalid')
             return self.form_invalid(form)
 
     def put(self, *args, **kwargs):